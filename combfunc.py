@@ -2,10 +2,15 @@
 import score
 import search
 import write
+import scheduler
+import journal
+import scratch
+import countystore
+from rotation import clearCache, setThreads
 import time
-import tifffile as tiff
 import os
 from multiprocessing import Pool
+from functools import partial
 import pandas as pd
 import tqdm
 import sys
@@ -15,8 +20,16 @@ t0 = time.time()
 
 county = sys.argv[1]
 
+# Optional memory budget for running parcels in GB, defaults to 70% of physical memory.
+if len(sys.argv) > 2:
+    budget = float(sys.argv[2])*1024**3
+else:
+    budget = scheduler.memoryBudget()
 
-def main(i):
+
+# Windowed parcels are scored and searched with their large arrays memory-mapped in a scratch directory.
+# Threads above 1 score the parcel and prepare and search its rotations in parallel, with the OpenCV warp on as many threads.
+def main(i, windowed=False, threads=1):
     # Minimum acceptable AOI acreage
     minAcres = 20
     # Maximum acceptable AOI acreage
@@ -29,37 +42,115 @@ def main(i):
     resultsDir = os.path.join(srcDir, 'results')
     if os.path.isdir(resultsDir) == False:
         os.mkdir(resultsDir)
-    outDir = os.path.join(srcDir, 'results/dir/')
+    if windowed:
+        scratch.startScratch(os.path.join(srcDir, 'scratch'))
+    setThreads(threads)
 
-    # Retrieve composite score and water mask raster from score.scoreParcel.
-    scoreIMG, dtw = score.scoreParcel('{}'.format(county), i, minAcres, maxAcres)
+    # Retrieve composite score, water mask and valid pixel rasters from score.scoreParcel.
+    # A failure is journaled as an error like one of the search, so the run goes on and the parcel is run again.
+    try:
+        scoreIMG, dtw, valid = score.scoreParcel('{}'.format(county), i, minAcres, maxAcres, threads=threads)
+    except Exception as e:
+        print('Failed', i, repr(e))
+        scratch.clearScratch()
+        setThreads(1)
+        return [i, 0, 0, 0, 0, 0, 0, 'error'], None
 
 
     try:
         # Retrieve best AOI score sum, bounds, and rotation from search.parcelSearch.
-        sum, TLc, TLr, BRc, BRr, rotation, placeMatrix = search.parcelSearch(scoreIMG, dtw, minAcres, maxAcres)
+        result = search.parcelSearch(scoreIMG, dtw, minAcres, maxAcres, workers=threads, valid=valid)
+        if result is False: # Parcel is of unsuitable size.
+            return [i, 0, 0, 0, 0, 0, 0, 'unsuitable'], None
+        sum, TLc, TLr, BRc, BRr, rotation, placeMatrix = result
 
         if sum > 0: # Viable AOI exists.
-            # Use non-negative raster for .shp creation.
-            img = tiff.imread(os.path.join(srcDir, '{}_slope/{}'.format(county, i)))
-            overlay = write.overlay(img, TLc, TLr, BRc, BRr, rotation, placeMatrix)
-            masked = write.mask(img, write.convolve(write.reshape(img, overlay)))
-            write.projectWrite(outDir, masked, srcDir, i, sum, county)
-            return [i, sum, TLc, TLr, BRc, BRr, rotation]
+            # Use valid pixel mask for polygon creation, in the same frame as the search.
+            # Polygons are returned to the parent process, which writes every parcel's AOIs.
+            overlay = write.overlay(valid, TLc, TLr, BRc, BRr, rotation, placeMatrix)
+            masked = write.mask(valid, write.convolve(write.reshape(valid, overlay)))
+            aois = write.aoiFeatures(masked, srcDir, i, sum, county)
+            return [i, sum, TLc, TLr, BRc, BRr, rotation, 'written'], aois
 
         else:   # No viable AOI exists.
-            return [i, 0, 0, 0, 0, 0, 0]
+            return [i, 0, 0, 0, 0, 0, 0, 'none'], None
+
+    except Exception as e: # Any other failure, e.g. out of memory, is journaled so the parcel is run again.
+        print('Failed', i, repr(e))
+        return [i, 0, 0, 0, 0, 0, 0, 'error'], None
 
-    except: # Parcel is of unsuitable size.
-        return [i, 0, 0, 0, 0, 0, 0]
+    finally:    # Cached rotations and scratch arrays are only kept for the parcel's lifetime.
+        clearCache()
+        scratch.clearScratch()
+        setThreads(1)
+
+
+# Run a batch of (parcel, windowed, threads) tuples in one pool task.
+# Returns the journal row and AOI polygons, if any, of each parcel.
+def mainBatch(batch):
+    return [main(*task) for task in batch]
 
 
 if __name__ == '__main__':
     srcDir = score.getSourceDir('{}'.format(county))
     imgList = score.getImgList(srcDir, county)
-    pool = Pool(processes=9)
-    r = list(tqdm.tqdm(pool.imap(main, imgList), total=len(imgList)))
-    df = pd.DataFrame(r, columns=['Name', 'Sum', 'TLc', 'TLr', 'BRc', 'BRr', 'Rotation'])
+
+    # Parcels already in the journal of an earlier run are skipped.
+    resultsDir = os.path.join(srcDir, 'results')
+    os.makedirs(resultsDir, exist_ok=True)
+    journalPath = os.path.join(resultsDir, 'journal.csv')
+    done = journal.readJournal(journalPath)
+    imgList = [i for i in imgList if i not in done]
+    handle, writer = journal.openJournal(journalPath)
+
+    # Pool sized from the available cores.
+    # Each worker runs the OpenCV warp on one thread, as the pool already uses every core.
+    workers = scheduler.poolSize()
+    pool = Pool(processes=workers, initializer=setThreads, initargs=(1,))
+
+    # Estimate each parcel's cost and peak memory, then batch the small parcels so one task carries a similar load.
+    # Parcels in the county store are estimated from its mapped landcover instead of their tiffs.
+    if countystore.openStore(srcDir) is not None:
+        estimates = list(pool.imap_unordered(partial(scheduler.storeCost, srcDir), imgList, chunksize=64))
+    else:
+        lcPaths = [score.landcoverPath(county, i) for i in imgList]
+        estimates = list(pool.imap_unordered(scheduler.parcelCost, lcPaths, chunksize=64))
+    costs = {name: cost for name, cost, peak in estimates}
+    peaks = {name: peak for name, cost, peak in estimates}
+
+    # Parcels whose estimated peak memory exceeds the whole budget are run windowed.
+    windowed = {i for i in peaks if peaks[i] > budget}
+    peaks.update({i: scheduler.windowedPeak(peaks[i]) for i in windowed})
+    # Parcels too large for one core to finish with the rest are run on threads as well as their worker.
+    # Being the most expensive, they are admitted first and alongside the rest, within the memory budget,
+    # and their threads take over the cores left idle once the other parcels are done.
+    large = scheduler.largeParcels(costs, workers)
+    peaks.update({i: scheduler.threadedPeak(peaks[i]) for i in large if i not in windowed})
+    tasks = [[(i, i in windowed, workers if i in large else 1) for i in task]
+             for task in scheduler.batchParcels(costs, workers)]
+    memory = [max(peaks[i] for i, w, t in task) for task in tasks]
+
+    # Results are journaled as they complete, so one slow parcel doesn't hold up the rest.
+    # Tasks are only admitted while their estimated memory fits in the budget.
+    # AOI polygons are batch-inserted by this process alone into one GeoPackage, before their parcels are journaled.
+    aoiPath = os.path.join(resultsDir, 'aois.gpkg')
+    aois = None
+    with tqdm.tqdm(total=len(imgList)) as progress:
+        for batch in scheduler.admitTasks(pool, mainBatch, tasks, memory, budget, workers):
+            records = [rec for row, found in batch if found is not None for rec in found[1]]
+            if records:
+                if aois is None:
+                    aois = write.openAois(aoiPath, next(found[0] for row, found in batch if found is not None))
+                write.appendAois(aois, records)
+            journal.appendJournal(handle, writer, [row for row, found in batch])
+            progress.update(len(batch))
+    if aois is not None:
+        aois.close()
+    handle.close()
+
+    # Results of this and earlier runs are all read back from the journal.
+    df = pd.DataFrame(list(journal.readJournal(journalPath).values()), columns=journal.columns)
+    df[journal.columns[1:-1]] = df[journal.columns[1:-1]].apply(pd.to_numeric)
     df.to_csv(r'C:\AOI_Gen\pennsylvania\{}\results\dir.csv'.format(county), index=None, header=True)
     t1 = time.time()
     print('Time elapsed:', t1 - t0)
@@ -0,0 +1,121 @@
+# Module for the county store, every input layer of a county in one memory-mapped array with an index of its parcels.
+# The index maps each parcel to its pixel window and a packed mask of the pixels inside it.
+# Pool workers map the same files and take views of a parcel's window, so parcels are scored without
+# decoding or copying tiffs, and the page cache is shared between workers.
+import os
+import json
+import numpy as np
+from scratch import scratchArray, blocks
+
+# Directory of the store under the county source directory.
+storeDir = 'store'
+
+# Files of the store: the layers as one (layer,row,column) float32 array, the packed parcel masks,
+# and the index of layer names, nodata values, georeferencing and parcel windows.
+layersFile = 'layers.npy'
+masksFile = 'masks.npy'
+indexFile = 'index.json'
+
+# Stores mapped by this process, keyed by directory, with the index modification time they were read at.
+stores = {}
+
+# Return the store directory of a county source directory.
+def storePath(srcDir):
+    return os.path.join(srcDir,storeDir)
+
+# Return the files of a store, e.g. for the score cache key.
+def storeFiles(srcDir):
+    return [os.path.join(storePath(srcDir),f) for f in (layersFile,masksFile,indexFile)]
+
+# Map the store of a county source directory, or return None if the county has no store.
+# A store is mapped once per process, and mapped again if it has been rebuilt.
+def openStore(srcDir):
+    path = storePath(srcDir)
+    try:
+        mtime = os.stat(os.path.join(path,indexFile)).st_mtime_ns
+    except OSError:
+        return None
+    store = stores.get(path)
+    if store is None or store['mtime'] != mtime:
+        with open(os.path.join(path,indexFile)) as f:
+            index = json.load(f)
+        store = {
+                 'mtime':mtime,
+                 'layers':np.load(os.path.join(path,layersFile),mmap_mode='r'),
+                 'masks':np.load(os.path.join(path,masksFile),mmap_mode='r'),
+                 'names':index['names'],
+                 'nodata':index['nodata'],
+                 'transform':index['transform'],
+                 'crs':index['crs'],
+                 'parcels':index['parcels']
+                 }
+        stores[path] = store
+    return store
+
+# Return True if the county has a store holding the parcel.
+def hasParcel(srcDir,name):
+    store = openStore(srcDir)
+    return store is not None and name in store['parcels']
+
+# Return the parcel names of a store with their approximate size as Float64 tiffs, for score.getImgList.
+def parcelSizes(srcDir):
+    parcels = openStore(srcDir)['parcels']
+    return {name:p[2]*p[3]*8 for name,p in parcels.items()}
+
+# Return the mask of the pixels inside a parcel's window, unpacked a block of rows at a time into a scratch array.
+def parcelMask(store,name):
+    row,col,height,width,offset = store['parcels'][name]
+    packed = store['masks'][offset:offset+height*((width+7)//8)].reshape(height,(width+7)//8)
+    mask = scratchArray((height,width),bool)
+    for rows in blocks((height,width)):
+        mask[rows] = np.unpackbits(packed[rows],axis=1,count=width).view(bool)
+    return mask
+
+# Return the layers of a parcel as views of its window keyed by layer name, their nodata values and the parcel mask.
+# Pixels outside the mask belong to neighbouring parcels, and are read as nodata by score.scoreLayers.
+def parcelLayers(srcDir,name):
+    store = openStore(srcDir)
+    row,col,height,width,offset = store['parcels'][name]
+    window = (slice(row,row+height),slice(col,col+width))
+    layers = {d:store['layers'][i][window] for i,d in enumerate(store['names'])}
+    nodata = {d:float(n) for d,n in zip(store['names'],store['nodata'])}
+    return layers,nodata,parcelMask(store,name)
+
+# Return the affine transform (a,b,c,d,e,f) of a parcel's window and the store's coordinate system as WKT.
+def parcelTransform(srcDir,name):
+    store = openStore(srcDir)
+    row,col = store['parcels'][name][:2]
+    a,b,c,d,e,f = store['transform']
+    return (a,b,c+a*col+b*row,d,e,f+d*col+e*row),store['crs']
+
+# Create an empty store of the named layers over a grid of shape, returning the layer array to be filled.
+# The index is written last by writeIndex, so a store is only opened once complete.
+def createStore(srcDir,names,shape):
+    path = storePath(srcDir)
+    os.makedirs(path,exist_ok=True)
+    if os.path.isfile(os.path.join(path,indexFile)):
+        os.remove(os.path.join(path,indexFile))
+    return np.lib.format.open_memmap(os.path.join(path,layersFile),mode='w+',dtype=np.float32,
+                                     shape=(len(names),)+tuple(shape))
+
+# Return a parcel's boolean mask packed a row at a time, as the store keeps it, with its width.
+def packMask(mask):
+    return np.packbits(mask,axis=1),mask.shape[1]
+
+# Write the parcel masks and index of a store.
+# Parcels are (name, row, col, packed mask, width), the mask being the parcel's window of the store grid.
+# The transform of the store grid is given as (a,b,c,d,e,f), and its coordinate system as WKT.
+def writeIndex(srcDir,names,nodata,transform,crs,parcels):
+    path = storePath(srcDir)
+    index = {'names':names,'nodata':nodata,'transform':list(transform)[:6],'crs':crs,'parcels':{}}
+    packed = []
+    offset = 0
+    for name,row,col,rowBits,width in parcels:
+        index['parcels'][name] = [int(row),int(col),rowBits.shape[0],int(width),offset]
+        packed.append(rowBits.ravel())
+        offset += rowBits.size
+    np.save(os.path.join(path,masksFile),np.concatenate(packed) if packed else np.zeros(0,np.uint8))
+    tmpPath = os.path.join(path,indexFile+'.tmp')
+    with open(tmpPath,'w') as f:
+        json.dump(index,f)
+    os.replace(tmpPath,os.path.join(path,indexFile))
@@ -1,7 +1,12 @@
 # Module for holding GDAL functions for reprojection, rasterization, and computing proximity.
+# The steps of every layer and county form a dependency graph, run in parallel by runTasks.
+# A step is skipped when its outputs are newer than its inputs, from fingerprints kept beside the outputs.
 
 import os
-from gdal_proximity import proximityMain
+import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from gdal_proximity import proximityTiled, proximityVector
+import scheduler
 
 
 # Set function variables.
@@ -13,77 +18,189 @@ countyList = ['Albemarle','Amherst','Botetourt','Buchanan','Campbell','Carroll',
 
 coorSys = "32618"
 
-# Execute main function.
-for county in countyList:
-    allGDAL(county,state,coorSys)
-
-
-
-
-
-
-
-# Reproject all .shp files to desired UTM and standardize names.
-# Generate os command to iterate through inputs dict.
-def reprojectVector(county,path,coor):
-    os.chdir(path)
-    dict = {
-            'water.shp':'{}_wetlands.shp'.format(county),
-            '3phase.shp':'{}_3phase.shp'.format(county),
-            'buildings.shp':'{}_buildings.shp'.format(county),
-            'roads.shp':'{}_roads.shp'.format(county),
-            'parcelLines.shp':'{}_Parcellines.shp'.format(county)
+# Distances beyond which a layer's score no longer changes, so proximity stops there.
+# score.buildingScore is flat from 50m and score.waterScore from 9m.
+# The other layers are scored relative to their maximum distance, so are computed in full.
+maxDists = {
+            'DTB.tif':50,
+            'DTW.tif':9
             }
-    for i in dict.items():
-        srcPath = os.path.join(path,i[1])
-        dstPath = os.path.join(path,i[0])
-        # print(srcPath,dstPath)
-        print("Reprojecting",i[1])
-        command = 'ogr2ogr -q -f "ESRI Shapefile" -overwrite -progress {} {} -t_srs EPSG:{}'.format(dstPath,srcPath,coor)
-        # print(command)
-        os.system(command)
-
-# Rasterize all .shp files.
-# Generate os command to iterate through inputs dict.
-def gdal_rasterize(path):
-    os.chdir(path)
-    dict = {
-            'water.tif':'water.shp',
-            '3phase.tif':'3phase.shp',
-            'buildings.tif':'buildings.shp',
-            'roads.tif':'roads.shp',
-            'parcels.tif':'parcelLines.shp'
-            }
-    for i in dict.items():
-        srcPath = os.path.join(path,i[1])
-        dstPath = os.path.join(path,i[0])
-        print('Rasterizing',i[1])
-        os.system('gdal_rasterize -q -burn 1 -a_nodata -1 -tr 1 1 -q {} {}'.format(srcPath,dstPath))
-
-# Compute proximity of all raster mask file.
-# Generate os command to iterate through inputs dict.
-def gdal_proximity(path):
-    os.chdir(path)
-    dict = {
-            'DTW.tif':'water.tif',
-            'DT3P.tif':'3phase.tif',
-            'DTB.tif':'buildings.tif',
-            'DTR.tif':'roads.tif',
-            'DTP.tif':'parcels.tif'
-            }
-    for i in dict.items():
-        srcPath = os.path.join(path,i[1])
-        dstPath = os.path.join(path,i[0])
-        print('Proximizing',i[0])
-        proximityMain(srcPath,dstPath)
-        os.remove(srcPath)
 
-# Combines above helper functions.
-# Creates all outputs in local C:/ drive directory.
-def allGDAL(county,state,coor):
+# Chain of each layer: the county's .shp, its reprojection, raster and proximity raster.
+layerChain = [
+              ('{}_wetlands.shp','water.shp','water.tif','DTW.tif'),
+              ('{}_3phase.shp','3phase.shp','3phase.tif','DT3P.tif'),
+              ('{}_buildings.shp','buildings.shp','buildings.tif','DTB.tif'),
+              ('{}_roads.shp','roads.shp','roads.tif','DTR.tif'),
+              ('{}_Parcellines.shp','parcelLines.shp','parcels.tif','DTP.tif')
+              ]
+
+# Files making up a shapefile, fingerprinted together.
+shpParts = ['.shp','.shx','.dbf','.prj']
+
+# Fingerprint file of the steps whose outputs are in a directory.
+manifestName = 'gdal_funcs.json'
+
+# Run an os command, raising an error if it fails so the step is not recorded as done.
+def runCommand(command):
+    status = os.system(command)
+    if status != 0:
+        raise RuntimeError('Command failed ({}): {}'.format(status,command))
+
+# Reproject a .shp file to desired UTM under its standardized name.
+def reprojectLayer(srcPath,dstPath,coor):
+    print("Reprojecting",os.path.basename(srcPath))
+    runCommand('ogr2ogr -q -f "ESRI Shapefile" -overwrite -progress {} {} -t_srs EPSG:{}'.format(dstPath,srcPath,coor))
+
+# Rasterize a .shp file.
+def rasterizeLayer(srcPath,dstPath):
+    print('Rasterizing',os.path.basename(srcPath))
+    runCommand('gdal_rasterize -q -burn 1 -a_nodata -1 -tr 1 1 -q {} {}'.format(srcPath,dstPath))
+
+# Compute proximity of a raster mask file, up to the layer's distance in maxDists.
+# The raster mask is kept, so the chain can be rerun from any step.
+def proximityLayer(srcPath,dstPath,workers=None):
+    print('Proximizing',os.path.basename(dstPath))
+    proximityTiled(srcPath,dstPath,maxDist=maxDists.get(os.path.basename(dstPath)),workers=workers)
+
+# Rasterize a .shp file in memory and compute its proximity, up to the layer's distance in maxDists.
+# Only the proximity raster is written to disk.
+def vectorProximityLayer(srcPath,dstPath,workers=None):
+    print('Rasterizing and proximizing',os.path.basename(dstPath))
+    proximityVector(srcPath,dstPath,maxDist=maxDists.get(os.path.basename(dstPath)),workers=workers)
+
+# Return the tasks of a county's chain, each a dict of its function and arguments, input and output files,
+# and the step settings that also make its outputs out of date when changed.
+# Proximity steps run their tiles on procs processes each.
+# By default layers are rasterized in memory for proximity; set inMemory to False to keep the raster masks on disk.
+def countyTasks(county,state,coor,procs=None,inMemory=True):
     path = 'C:/aoi_gen//{}/{}/basedata'.format(state,county)
-    reprojectVector(county,path,coor)
-    gdal_rasterize(path)
-    gdal_proximity(path)
+    tasks = []
+    for src,shp,tif,dtx in layerChain:
+        srcPath,shpPath,tifPath,dtxPath = [os.path.join(path,f) for f in (src.format(county),shp,tif,dtx)]
+        tasks.append({'func':reprojectLayer,'args':(srcPath,shpPath,coor),'step':['reproject',coor],
+                      'inputs':shpFiles(srcPath),'outputs':shpFiles(shpPath)})
+        if inMemory:
+            tasks.append({'func':vectorProximityLayer,'args':(shpPath,dtxPath,procs),
+                          'step':['rasterize','proximity',maxDists.get(dtx)],
+                          'inputs':shpFiles(shpPath),'outputs':[dtxPath]})
+            continue
+        tasks.append({'func':rasterizeLayer,'args':(shpPath,tifPath),'step':['rasterize'],
+                      'inputs':shpFiles(shpPath),'outputs':[tifPath]})
+        tasks.append({'func':proximityLayer,'args':(tifPath,dtxPath,procs),'step':['proximity',maxDists.get(dtx)],
+                      'inputs':[tifPath],'outputs':[dtxPath]})
+    return tasks
+
+# Return the files of a shapefile.
+def shpFiles(shpPath):
+    base = os.path.splitext(shpPath)[0]
+    return [base+ext for ext in shpParts]
+
+# Return the size and modification time of each file, None for a missing file.
+def fingerprint(paths):
+    prints = {}
+    for p in paths:
+        try:
+            st = os.stat(p)
+            prints[p] = [st.st_size,st.st_mtime_ns]
+        except OSError:
+            prints[p] = None
+    return prints
+
+# Return the record of a task: its step, the fingerprints of its inputs and of its outputs.
+# Optional files, like a missing .prj, are fingerprinted as missing.
+def taskRecord(task):
+    return {'step':task['step'],'inputs':fingerprint(task['inputs']),'outputs':fingerprint(task['outputs'])}
+
+# Return the manifest path of a task, beside its first output.
+def manifestPath(task):
+    return os.path.join(os.path.dirname(task['outputs'][0]),manifestName)
+
+# Return True if the task's outputs are as recorded after it last ran, with the same step on the same inputs.
+def upToDate(task,manifests):
+    record = manifests.get(manifestPath(task),{}).get(task['outputs'][0])
+    current = taskRecord(task)
+    return current['outputs'][task['outputs'][0]] is not None and record == current
+
+# Read the manifest of a directory, empty if it has none.
+def readManifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return {}
+
+# Record a finished task in its manifest, written under a temporary name first.
+def recordTask(task,manifests):
+    path = manifestPath(task)
+    manifests[path][task['outputs'][0]] = taskRecord(task)
+    with open(path+'.tmp','w') as f:
+        json.dump(manifests[path],f,indent=1)
+    os.replace(path+'.tmp',path)
+
+# Run tasks in dependency order, up to workers at once, skipping those already up to date.
+# A task depends on the tasks producing its inputs. Tasks after a failed one are not run.
+# Returns the outputs of the tasks run or up to date, and of those failed or not run.
+def runTasks(tasks,workers=4):
+    names = [t['outputs'][0] for t in tasks]
+    producers = {out:name for name,t in zip(names,tasks) for out in t['outputs']}
+    deps = {name:{producers[i] for i in t['inputs'] if i in producers} for name,t in zip(names,tasks)}
+    pending = dict(zip(names,tasks))
+    manifests = {}
+    for t in tasks:
+        if manifestPath(t) not in manifests:
+            manifests[manifestPath(t)] = readManifest(manifestPath(t))
+
+    done = set()
+    failed = set()
+    running = {}
+    with ThreadPoolExecutor(workers) as executor:
+        while pending or running:
+            # Start every task whose dependencies are done, or pass it if already up to date.
+            for name in list(pending):
+                if deps[name]&failed:
+                    failed.add(name)
+                    del pending[name]
+                elif deps[name] <= done:
+                    task = pending.pop(name)
+                    if upToDate(task,manifests):
+                        done.add(name)
+                    else:
+                        running[executor.submit(task['func'],*task['args'])] = task
+            if not running:
+                continue
+
+            # Each finished task is recorded by this thread only.
+            finished,_ = wait(running,return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                name = task['outputs'][0]
+                if future.exception() is not None:
+                    print('Failed',name,future.exception())
+                    failed.add(name)
+                else:
+                    recordTask(task,manifests)
+                    done.add(name)
+    return done,failed
 
+# Combines above helper functions.
+# Creates all outputs in local C:/ drive directory, rerunning only the steps that are out of date.
+def allGDAL(county,state,coor,workers=4,inMemory=True):
+    return runCounties([county],state,coor,workers,inMemory)
 
+# Run the chains of several counties as one graph, so layers and counties run in parallel.
+# Proximity tiles share the cores between the workers.
+# Each layer rasterized in memory holds a byte per pixel of its extent while its proximity runs.
+def runCounties(counties,state,coor,workers=4,inMemory=True):
+    procs = max(1,scheduler.poolSize()//workers)
+    tasks = []
+    for county in counties:
+        tasks += countyTasks(county,state,coor,procs,inMemory)
+    return runTasks(tasks,workers)
+
+
+# Execute main function.
+if __name__ == '__main__':
+    done,failed = runCounties(countyList,state,coorSys)
+    if failed:
+        print('Not completed:',sorted(failed))
@@ -1,8 +1,14 @@
 # Create raster measuring pixel distance to objects within .shp file.
 # Modified from https://github.com/kubaszostak
+# proximityTiled computes the same distances on tiles across multiple cores.
 import os.path
 import sys
-from osgeo import gdal
+import math
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+from multiprocessing import Pool, shared_memory
+from osgeo import gdal, ogr, gdal_array
 
 # Find current filetype of input raster.
 def GetExtension(filename):
@@ -120,3 +126,212 @@ def proximityMain(source,destination):
     dstband = None
     src_ds = None
     dst_ds = None
+
+
+# Tile size of proximityTiled, in pixels.
+tileSize = 2048
+
+# Halo first tried for each tile, enough for most tiles of dense layers like roads and parcel lines.
+firstHalo = 256
+
+# Largest halo of a tile's distance transform, so a worker never holds more than a
+# (tileSize+2*maxHalo) square window however far the targets are.
+maxHalo = 512
+
+# Pixels per nearest-target query of the pixels beyond a tile's halo.
+queryPoints = 1<<19
+
+# Jitter of the edge targets in the nearest-target tree, in pixels.
+# Pixel distances differ by at least 1/(2*distance), so ties can't swap the nearest target below 1e6 pixels.
+tieJitter = 1e-7
+
+# Source of the current proximityTiled worker, set by openSource.
+tileSource = {}
+
+# Open the source raster once in each worker.
+# A source of (name, shape) is a raster in shared memory, mapped by name as proximityVector leaves it.
+def openSource(source,band=1):
+    if isinstance(source,str):
+        tileSource['ds'] = gdal.Open(source)
+        tileSource['band'] = tileSource['ds'].GetRasterBand(band)
+        tileSource['size'] = (tileSource['ds'].RasterYSize,tileSource['ds'].RasterXSize)
+    else:
+        name,shape = source
+        tileSource['shm'] = shared_memory.SharedMemory(name=name)
+        tileSource['array'] = np.ndarray(shape,dtype=np.uint8,buffer=tileSource['shm'].buf)
+        tileSource['size'] = shape
+
+# Read a window of the worker's source raster.
+def readWindow(x,y,w,h):
+    if 'array' in tileSource:
+        return tileSource['array'][y:y+h,x:x+w]
+    return tileSource['band'].ReadAsArray(x,y,w,h)
+
+# Return the tiles (xoff,yoff,xsize,ysize) of size pixels covering a raster of xSize by ySize pixels.
+def rasterTiles(xSize,ySize,size):
+    return [(x,y,min(size,xSize-x),min(size,ySize-y)) for y in range(0,ySize,size) for x in range(0,xSize,size)]
+
+# Return True if a tile holds any target pixel, of value 1.
+def tileHasTarget(tile):
+    return bool((readWindow(*tile)==1).any())
+
+# Distances of the tile from targets within halo pixels around it.
+# Returns None where the halo holds no target.
+def haloDistance(tile,halo):
+    x,y,w,h = tile
+    ySize,xSize = tileSource['size']
+    x0,y0 = max(0,x-halo),max(0,y-halo)
+    x1,y1 = min(xSize,x+w+halo),min(ySize,y+h+halo)
+    targets = readWindow(x0,y0,x1-x0,y1-y0)==1
+    if not targets.any():
+        return None
+    return ndimage.distance_transform_edt(~targets)[y-y0:y-y0+h,x-x0:x-x0+w].astype(np.float32)
+
+# Return the row and column of every target pixel on the edge of its target area within the given tiles.
+# The nearest target of any other pixel is always such a pixel, as a target with targets on all four sides
+# has a neighbour closer to that pixel. Pixels on a tile's border are all taken, which only adds candidates.
+def edgeTargets(tiles):
+    points = [np.zeros((0,2),dtype=np.int64)]
+    for x,y,w,h in tiles:
+        targets = readWindow(x,y,w,h)==1
+        rows,cols = np.nonzero(targets&~ndimage.binary_erosion(targets))
+        points.append(np.stack([rows+y,cols+x],axis=1))
+    return np.concatenate(points)
+
+# Write the distances of the far pixels of a tile to their nearest of points, up to reach.
+# Pixels are queried a block at a time, so a tile far from every target needs no window around it.
+# Edge targets share rows and columns by the thousand, e.g. along roads and lines, which makes the tree
+# many times slower to query. The points are jittered by tieJitter to break the ties, and the distance
+# measured to the nearest pixel itself, so distances stay exact.
+def farDistance(dist,far,tile,points,reach):
+    x,y,w,h = tile
+    jitter = np.random.default_rng(0).uniform(-tieJitter,tieJitter,points.shape)
+    tree = cKDTree(points+jitter,compact_nodes=False)
+    rows,cols = np.nonzero(far)
+    for n in range(0,len(rows),queryPoints):
+        r,c = rows[n:n+queryPoints]+y,cols[n:n+queryPoints]+x
+        nearest = tree.query(np.stack([r,c],axis=1),distance_upper_bound=reach+1)[1]
+        found = nearest<len(points)
+        d = np.full(len(r),np.inf,dtype=np.float32)
+        d[found] = np.hypot(r[found]-points[nearest[found],0],c[found]-points[nearest[found],1])
+        dist[r-y,c-x] = d
+
+# Compute the distances of one tile from the tile and a halo of pixels around it.
+# Any target within halo of a pixel is inside the window read, so every distance up to halo is exact.
+# A small halo is tried first, and up to maxHalo only if some distances are beyond it.
+# Every distance of the tile is at most reach. Distances beyond the last halo tried are found
+# from the edge targets of the candidate tiles, those holding targets within reach of the tile.
+# Distances over maxDist are written as maxDist, and pixels with no target in reach are -1.
+def proximityTile(args):
+    tile,halo,reach,maxDist,candidates = args
+    x,y,w,h = tile
+    for tryHalo in sorted({min(firstHalo,halo),halo}):
+        dist = haloDistance(tile,tryHalo)
+        if dist is not None and dist.max() <= tryHalo:
+            break
+    if tryHalo < reach and candidates:
+        far = np.ones((h,w),dtype=bool) if dist is None else dist>tryHalo
+        points = edgeTargets(candidates)
+        if far.any() and len(points):
+            if dist is None:
+                dist = np.full((h,w),np.inf,dtype=np.float32)
+            farDistance(dist,far,tile,points,reach)
+    if dist is None:
+        dist = np.full((h,w),-1 if maxDist is None else maxDist,dtype=np.float32)
+    elif maxDist is not None:
+        np.minimum(dist,np.float32(maxDist),out=dist)
+    return tile,dist
+
+# Creates proximized raster like proximityMain, in pixel distances to pixels of value 1, as Float32.
+# Tiles are computed in parallel by workers, each with a halo of at most maxHalo.
+# Pixels beyond it are measured from the targets of the tiles within reach, so distances are exact
+# however far the nearest target is.
+# With maxDist, halos reach no further than maxDist and longer distances are written as maxDist,
+# for layers whose scores no longer change beyond it.
+# Without maxDist, pixels with no target in the raster are -1, as NODATA=-1 gave.
+def proximityTiled(source,destination,maxDist=None,workers=None):
+    src_ds = gdal.Open(source)
+    # Error if source file does not exist.
+    if src_ds is None:
+        print('Unable to open %s' % source)
+        sys.exit(1)
+    xSize,ySize = src_ds.RasterXSize,src_ds.RasterYSize
+    geoTransform,projection = src_ds.GetGeoTransform(),src_ds.GetProjectionRef()
+    src_ds = None
+    computeTiles(source,xSize,ySize,geoTransform,projection,destination,maxDist,workers)
+
+# Creates proximized raster from a .shp file, rasterized in memory as gdal_rasterize -burn 1 -tr 1 1 would,
+# so only the proximity raster is written to disk.
+# The features are burnt straight into shared memory, which the tile workers map in place of a raster file.
+def proximityVector(shpPath,destination,maxDist=None,workers=None,res=1):
+    src = ogr.Open(shpPath)
+    # Error if source file does not exist.
+    if src is None:
+        print('Unable to open %s' % shpPath)
+        sys.exit(1)
+    layer = src.GetLayer()
+    minX,maxX,minY,maxY = layer.GetExtent()
+    xSize,ySize = int((maxX-minX)/res+0.5),int((maxY-minY)/res+0.5)
+    geoTransform = (minX,res,0,maxY,0,-res)
+    srs = layer.GetSpatialRef()
+    projection = srs.ExportToWkt() if srs is not None else ''
+
+    shm = shared_memory.SharedMemory(create=True,size=max(1,xSize*ySize))
+    try:
+        targets = np.ndarray((ySize,xSize),dtype=np.uint8,buffer=shm.buf)
+        targets[:] = 0
+        mem_ds = gdal_array.OpenArray(targets)
+        mem_ds.SetGeoTransform(geoTransform)
+        mem_ds.SetProjection(projection)
+        gdal.RasterizeLayer(mem_ds,[1],layer,burn_values=[1])
+        mem_ds = None
+        del targets
+        computeTiles((shm.name,(ySize,xSize)),xSize,ySize,geoTransform,projection,destination,maxDist,workers)
+    finally:
+        shm.close()
+        shm.unlink()
+    src = None
+
+# Return the tiles holding targets within reach pixels of tile, those a pixel of the tile may be nearest to.
+# None are needed while reach is within maxHalo, as the tile's own halo then holds them all.
+def candidateTiles(tile,reach,targetTiles):
+    if reach <= maxHalo or len(targetTiles) == 0:
+        return []
+    x,y,w,h = tile
+    tx,ty,tw,th = targetTiles.T
+    dx = np.maximum(0,np.maximum(tx-(x+w-1),x-(tx+tw-1)))
+    dy = np.maximum(0,np.maximum(ty-(y+h-1),y-(ty+th-1)))
+    return [tuple(t) for t in targetTiles[np.hypot(dx,dy)<=reach].tolist()]
+
+# Compute the proximity raster of source, a raster file or a raster in shared memory, tile by tile.
+def computeTiles(source,xSize,ySize,geoTransform,projection,destination,maxDist=None,workers=None):
+
+    # Create output file.
+    drv = gdal.GetDriverByName(GetOutputDriverFor(destination))
+    dst_ds = drv.Create(destination,xSize,ySize,1,gdal.GDT_Float32,['TILED=YES','BIGTIFF=IF_SAFER'])
+    dst_ds.SetGeoTransform(geoTransform)
+    dst_ds.SetProjection(projection)
+    dstband = dst_ds.GetRasterBand(1)
+
+    tiles = rasterTiles(xSize,ySize,tileSize)
+    with Pool(processes=workers,initializer=openSource,initargs=(source,)) as pool:
+
+        # Tiles holding targets are found first, and each tile's reach set from the distance to the nearest one.
+        # A target in a tile d tile widths away, centre to centre, is at most (d+sqrt(2)) tile widths from any pixel.
+        grid = np.array(pool.map(tileHasTarget,tiles)).reshape(math.ceil(ySize/tileSize),math.ceil(xSize/tileSize))
+        if grid.any():
+            reaches = np.ceil((ndimage.distance_transform_edt(~grid).ravel()+math.sqrt(2))*tileSize).astype(int)
+        else:
+            reaches = np.zeros(len(tiles),dtype=int)
+        if maxDist is not None:
+            reaches = np.minimum(reaches,math.ceil(maxDist))
+        targetTiles = np.array(tiles)[grid.ravel()]
+
+        # Tiles are written by this process as the workers finish them.
+        args = [(t,int(min(r,maxHalo)),int(r),maxDist,candidateTiles(t,r,targetTiles)) for t,r in zip(tiles,reaches)]
+        for tile,dist in pool.imap_unordered(proximityTile,args):
+            dstband.WriteArray(dist,tile[0],tile[1])
+
+    dstband = None
+    dst_ds = None
+
@@ -0,0 +1,43 @@
+# Module for the checkpoint journal of county runs.
+# Each parcel result is appended as one csv row as soon as it completes, so a rerun can skip it.
+import os
+import csv
+
+columns = ['Name', 'Sum', 'TLc', 'TLr', 'BRc', 'BRr', 'Rotation', 'Status']
+
+# Output geometry status of a parcel, the last journal column.
+statuses = ['written', 'none', 'unsuitable']
+
+# Return the complete rows of the journal, keyed by parcel name.
+# A row cut short by a crash, or of a parcel that failed ('error'), is ignored, so that parcel is run again.
+def readJournal(path):
+    rows = {}
+    if not os.path.isfile(path):
+        return rows
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) == len(columns) and row[-1] in statuses:
+                rows[row[0]] = row
+    return rows
+
+# Open the journal for appending, writing the header to a new journal.
+def openJournal(path):
+    new = not os.path.isfile(path) or os.path.getsize(path) == 0
+    handle = open(path, 'a', newline='')
+
+    # Start on a new line if the last row was cut short.
+    if not new:
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                handle.write('\r\n')
+    writer = csv.writer(handle)
+    if new:
+        writer.writerow(columns)
+    return handle, writer
+
+# Append result rows and force them to disk.
+def appendJournal(handle, writer, results):
+    writer.writerows(results)
+    handle.flush()
+    os.fsync(handle.fileno())
@@ -1,8 +1,30 @@
 # Module for the splitting of large raster files into parcels.
+# Each county raster is opened once per worker and parcels are clipped from windowed reads in-process,
+# rather than by a gdalwarp cutline process for every parcel and layer.
+# Parcels are written as one tiff per layer directory, or stacked as one multi-page tiff per parcel.
+# Distance layers can be computed per parcel from the shapefiles instead of clipped from county-wide rasters.
+# Alternatively buildStore writes the county store of countystore.py, every layer in one array with a parcel index.
 
 import os
+import math
 import fiona
-import gdal
+import rasterio
+import numpy as np
+import tifffile as tiff
+import tqdm
+import shapely
+import shapely.geometry
+from scipy import ndimage
+from rasterio import features, windows
+from rasterio.transform import Affine
+from rasterio.vrt import WarpedVRT
+from rasterio.enums import Resampling
+from multiprocessing import Pool
+from functools import partial
+import scheduler
+import countystore
+from gdal_funcs import maxDists
+from scratch import blocks
 
 # Set variables for main function.
 state = 'pennsylvania'
@@ -11,84 +33,354 @@ countyList = ['Albemarle','Amherst','Botetourt','Buchanan','Campbell','Carroll',
               'Grayson','Henry','Lynchburg','Martinsville','Montgomery','Nelson','Patrick','Pittsylvania','Pulaski',
               'Radford','Roanoke','Russell','Scott','Tazewell','Wise']
 
-# Execute main function.
-for c in countyList:
-    mainSplit(c)
+# Parcels clipped per worker task.
+batchSize = 256
+
+# Open rasters of the current worker, as (dataset, nodata, output directory) keyed by layer name.
+# Set once per worker by openRasters.
+rasters = {}
 
+# Spatial indexes of the current worker's vector layers, as (STRtree, features, nodata, output directory, maxDist)
+# keyed by layer name. Set once per worker by openRasters.
+vectors = {}
 
+# Vector layers whose distances are computed per parcel with vectorProximity, from gdal_funcs' reprojected shapefiles.
+vectorLayers = {
+                'dtw':'water.shp',
+                'dt3p':'3phase.shp',
+                'dtb':'buildings.shp',
+                'dtr':'roads.shp',
+                'dtp':'parcelLines.shp'
+                }
 
+# Output of the current worker: the stack directory, or None for per-layer directories,
+# and the GeoTIFF keys of the county's coordinate system for stacked files.
+output = {'stackDir':None,'geoKeys':[]}
 
+# Directory of the stacked parcel files, beside the per-layer directories.
+stackDir = 'stack'
 
+# Tile size of stacked pages.
+stackTile = (256,256)
 
-def mainSplit(state,county):
+# Return the rasters to be split as (raster file, output directory name, nodata) tuples.
+# Landcover comes first, so it is the georeferenced first page of a stacked parcel.
+def layerList(county):
 
     # List of rasters to be split.
-    tifList =['{}_aspect.tif'.format(county),
-              '{}_landcover.tif'.format(county),
+    tifList =['{}_landcover.tif'.format(county),
+              '{}_aspect.tif'.format(county),
               'dtp.tif','dt3p.tif',
               'dtb.tif','dtr.tif',
               'dtw.tif','{}_slope.tif'.format(county)]
 
+    layers = []
     for t in tifList:
-
-        # Echo progress updates.
-        print('Working on',t)
-
         if t == '{}_slope.tif'.format(county):
             nodata = -1
         else:
             nodata = 0
+        layers.append((t,os.path.splitext(t)[0],nodata))
+    return layers
+
+# Check raster cell size, resampling into 1m pixel resolution if needed.
+# Returns the path of the 1m raster.
+def resampleRaster(im):
+    with rasterio.open(im) as raster:
+        xSize, ySize = raster.res
+
+    # Pass if resolution is 1m.
+    if xSize==1.0 and ySize==1.0:
+        return im
+
+    print('Resampling',im)
+    im02 = os.path.splitext(im)[0]+'02.tif'
+    os.system('gdalwarp -tr 1 1 -r near -dstnodata -1 -overwrite {} {}'.format(im,im02))
+    return im02
+
+# Read the .shp file in one pass, returning (U_ID, geometries) for each unique feature ID.
+# Features sharing a U_ID are clipped together, as gdalwarp -cwhere selected them all.
+def readParcels(shp):
+    parcels = {}
+    with fiona.open(shp) as src:
+        for feat in src:
+            geom = feat['geometry']
+            if geom is None:
+                continue
+            # Geometries are kept as plain GeoJSON dicts so batches pickle to the workers.
+            geom = getattr(geom,'__geo_interface__',geom)
+            parcels.setdefault(str(feat['properties']['U_ID']),[]).append(geom)
+    return list(parcels.items())
+
+# Open every raster once in a worker, for all of the parcels it clips.
+# Stacked parcels are written to stack, with the coordinate system keys of the first raster.
+# Vector layers are read and spatially indexed once in each worker too.
+def openRasters(layers,stack=None,vectorList=()):
+    for im,dstDir,newDir,nodata in layers:
+        rasters[dstDir] = (rasterio.open(im),nodata,newDir)
+    for shp,dstDir,newDir,nodata,maxDist in vectorList:
+        with fiona.open(shp) as src:
+            feats = [shapely.geometry.shape(feat['geometry']) for feat in src if feat['geometry'] is not None]
+        vectors[dstDir] = (shapely.STRtree(feats),feats,nodata,newDir,maxDist)
+    output['stackDir'] = stack
+    if stack is not None:
+        output['geoKeys'] = geoKeys(layers[0][0])
+
+# Return the GeoTIFF key tags of a raster as tifffile extratags, copied unchanged to stacked parcels.
+def geoKeys(path):
+    tags = []
+    with tiff.TiffFile(path) as tif:
+        page = tif.pages[0]
+        for code,dtype in ((34735,'H'),(34736,'d'),(34737,'s')):
+            tag = page.tags.get(code)
+            if tag is not None:
+                value = tag.value
+                if dtype != 's':
+                    value = tuple(np.atleast_1d(value))
+                tags.append((code,dtype,0 if dtype == 's' else len(value),value,True))
+    return tags
+
+# Return the GeoTIFF tags placing a north-up parcel window at transform, with the county's coordinate system.
+def georeference(transform):
+    scale = (transform.a,-transform.e,0.0)
+    tiepoint = (0.0,0.0,0.0,transform.c,transform.f,0.0)
+    return [(33550,'d',3,scale,True),(33922,'d',6,tiepoint,True)]+output['geoKeys']
+
+# Return the window of a raster grid covering the geometries, snapped outwards to whole pixels.
+def parcelWindow(geoms,transform):
+    bounds = np.array([features.bounds(g) for g in geoms])
+    w = windows.from_bounds(bounds[:,0].min(),bounds[:,1].min(),bounds[:,2].max(),bounds[:,3].max(),transform)
+
+    # Small tolerance so bounds on pixel edges don't add a row or column of nodata.
+    col0,row0 = math.floor(w.col_off+1e-6),math.floor(w.row_off+1e-6)
+    col1,row1 = math.ceil(w.col_off+w.width-1e-6),math.ceil(w.row_off+w.height-1e-6)
+    return windows.Window(col0,row0,col1-col0,row1-row0)
+
+# Clip one parcel from a raster, returning the clipped array and its transform, or None if the parcel is off the raster.
+# Pixels whose centre is outside the parcel, or nodata in the source, are set to the layer nodata as gdalwarp did.
+# Rasters on the same grid share the rasterized parcel mask in masks.
+def clipLayer(src,nodata,geoms,masks,dtype=np.float64):
+    window = parcelWindow(geoms,src.transform)
+    if window.width <= 0 or window.height <= 0:
+        return None
+    shape = (window.height,window.width)
+    transform = windows.transform(window,src.transform)
+    key = (tuple(transform),shape)
+    if key not in masks:
+        masks[key] = features.geometry_mask(geoms,shape,transform)
+
+    # Parcels over the raster edge are read boundless, filled with nodata.
+    inside = window.col_off >= 0 and window.row_off >= 0 and \
+             window.col_off+window.width <= src.width and window.row_off+window.height <= src.height
+    img = src.read(1,window=window,boundless=not inside,fill_value=nodata).astype(dtype)
+    outside = masks[key].copy()
+    if src.nodata is not None:
+        if np.isnan(src.nodata):
+            outside |= np.isnan(img)
+        else:
+            outside |= img==src.nodata
+    img[outside] = nodata
+    return img,transform
+
+# Compute a parcel's distances to the features of a vector layer, in pixels, on the parcel window of shape at transform.
+# Only features near the window are rasterized, burnt as gdal_rasterize did, on the window and a buffer around it.
+# The buffer reaches the feature nearest the window from every pixel, or maxDist beyond which distances are maxDist,
+# so distances are those a county-wide proximity raster on the same grid would give. With no feature in reach, they are -1.
+def vectorDistance(tree,feats,shape,transform,maxDist):
+    h,w = shape
+    left,top = transform.c,transform.f
+    box = shapely.box(left,top+h*transform.e,left+w*transform.a,top)
+    nearest,reach = tree.query_nearest(box,return_distance=True)
+    if len(nearest) == 0:
+        return np.full(shape,-1,dtype=np.float32)
 
-        # Check for output directory and input .shp file.
-        srcDir = 'C:/{}/{}/basedata'.format(state,county)
-        print(srcDir)
-        os.chdir(srcDir)
-        im = os.path.join(srcDir,t)
-        shp = os.path.join(srcDir,'{}_parcels.shp'.format(county))
-        dstDir = os.path.splitext(t)[0]
-
-        # Open Raster and check cell size.
-        print('Opening raster')
-        raster = gdal.Open(im)
-        print('Raster opened')
-        xSize, ySize = raster.GetGeoTransform()[1],-raster.GetGeoTransform()[5]
-
-        # Pass if resolution is 1m.
-        if xSize==1.0 and ySize==1.0:
-            pass
-        # Else, resample into 1m pixel resolution.
+    # Nearest feature to the window, plus the window's diagonal, bounds the distance from any of its pixels.
+    buffer = reach.min()+math.hypot(h*transform.e,w*transform.a)
+    if maxDist is not None:
+        buffer = min(buffer,maxDist)
+    pad = math.ceil(buffer/abs(transform.a))+1
+    padShape = (h+2*pad,w+2*pad)
+    padTransform = transform*Affine.translation(-pad,-pad)
+    near = [feats[i] for i in tree.query(box.buffer(pad*abs(transform.a),join_style='mitre'))]
+    burnt = features.rasterize(near,out_shape=padShape,transform=padTransform,fill=0,default_value=1,dtype='uint8')
+    if not burnt.any():
+        return np.full(shape,-1 if maxDist is None else maxDist,dtype=np.float32)
+    dist = ndimage.distance_transform_edt(burnt==0)[pad:pad+h,pad:pad+w].astype(np.float32)
+    if maxDist is not None:
+        np.minimum(dist,np.float32(maxDist),out=dist)
+    return dist
+
+# Yield (layer name, output directory, nodata, array, transform, crs) for each layer of a parcel.
+# Rasters are clipped in the compact dtype of the raster, and vector layers computed as float32 on the
+# landcover window, the first raster's, with pixels outside the parcel set to nodata.
+def parcelLayers(geoms):
+    masks = {}
+    ref = None
+    for dstDir,(src,nodata,newDir) in rasters.items():
+        dtype = np.result_type(src.dtypes[0],np.min_scalar_type(nodata))
+        clip = clipLayer(src,nodata,geoms,masks,dtype)
+        if clip is None:
+            continue
+        img,transform = clip
+        if ref is None:
+            ref = (img.shape,transform,src.crs)
+        yield dstDir,newDir,nodata,img,transform,src.crs
+    if ref is None:
+        return
+
+    shape,transform,crs = ref
+    outside = masks[(tuple(transform),shape)]
+    for dstDir,(tree,feats,nodata,newDir,maxDist) in vectors.items():
+        img = vectorDistance(tree,feats,shape,transform,maxDist)
+        img[outside] = nodata
+        yield dstDir,newDir,nodata,img,transform,crs
+
+# Clip one parcel from every layer, writing it as U_ID.tif to each output directory as Float64.
+def splitParcel(uid,geoms):
+    for dstDir,newDir,nodata,img,transform,crs in parcelLayers(geoms):
+        with rasterio.open(os.path.join(newDir,'{}.tif'.format(uid)),'w',driver='GTiff',
+                           height=img.shape[0],width=img.shape[1],count=1,dtype='float64',
+                           crs=crs,transform=transform,nodata=nodata) as dst:
+            dst.write(img.astype(np.float64),1)
+
+# Clip one parcel from every layer, writing all layers to U_ID.tif in the stack directory.
+# Each layer is a tiled page in the compact dtype of its raster, named by its ImageDescription,
+# with its nodata in the GDAL_NODATA tag. The first page, landcover, is georeferenced.
+def stackParcel(uid,geoms):
+    path = os.path.join(output['stackDir'],'{}.tif'.format(uid))
+    tmpPath = '{}.{}.tmp'.format(path,os.getpid())
+    first = True
+    with tiff.TiffWriter(tmpPath) as tw:
+        for dstDir,newDir,nodata,img,transform,crs in parcelLayers(geoms):
+            tags = [(42113,'s',0,str(nodata),True)]
+            if first:
+                tags += georeference(transform)
+                first = False
+            tw.write(img,tile=stackTile,description=dstDir,metadata=None,extratags=tags)
+    os.replace(tmpPath,path)
+
+# Clip a batch of parcels, returning the number clipped.
+def splitBatch(batch):
+    for uid,geoms in batch:
+        if output['stackDir'] is None:
+            splitParcel(uid,geoms)
         else:
-            print('Resampling',im)
-            im02 = os.path.splitext(im)[0]+'02.tif'
-            os.system('gdalwarp -tr 1 1 -r near -dstnodata -1 -overwrite {} {}'.format(im,im02))
-            im = im02
-
-        # Create holding lists for unique feature IDs.
-        featIDs01 = []
-        featIDs02 = []
-
-        # Test that .shp file is uncorrupted and valid.
-        test = fiona.open(shp)
-
-        # Unique feature IDs written to list.
-        print('Reading shp features')
-        for feat in fiona.open(shp):
-            featIDs01.append(str(feat['properties']['U_ID']))
-        for feat in featIDs01:
-            featIDs02.append('"'+feat+'"')
-
-        # Output directory created for each input raster.
+            stackParcel(uid,geoms)
+    return len(batch)
+
+# Set stacked to write one multi-page tiff per parcel to the county's stack directory.
+# Set vectorProximity to compute the distance layers of each parcel from the shapefiles near it,
+# in place of clipping them from county-wide proximity rasters.
+def mainSplit(state,county,workers=None,stacked=False,vectorProximity=False):
+
+    # Check for output directory and input .shp file.
+    srcDir = 'C:/{}/{}/basedata'.format(state,county)
+    print(srcDir)
+    shp = os.path.join(srcDir,'{}_parcels.shp'.format(county))
+
+    # Output directory created for each input raster, or one for the stacked parcels.
+    stack = None
+    if stacked:
+        stack = os.path.join('C://{}/{}/'.format(state,county),stackDir)
+        os.makedirs(stack,exist_ok=True)
+
+    layers = []
+    vectorList = []
+    for t,dstDir,nodata in layerList(county):
         newDir = os.path.join('C://{}/{}/'.format(state,county),dstDir)
-        if os.path.isdir(newDir) == False:
+        if not stacked and os.path.isdir(newDir) == False:
             os.mkdir(newDir)
             print('Creating dir',newDir)
+        if vectorProximity and dstDir in vectorLayers:
+            maxDist = maxDists.get('{}.tif'.format(dstDir.upper()))
+            vectorList.append((os.path.join(srcDir,vectorLayers[dstDir]),dstDir,newDir,nodata,maxDist))
+        else:
+            layers.append((resampleRaster(os.path.join(srcDir,t)),dstDir,newDir,nodata))
+
+    # Unique feature IDs and their geometries read once for all rasters.
+    print('Reading shp features')
+    parcels = readParcels(shp)
+    batches = [parcels[i:i+batchSize] for i in range(0,len(parcels),batchSize)]
+
+    # Batches of parcels clipped in parallel, each worker holding its own open rasters.
+    print('Clipping rasters')
+    if workers is None:
+        workers = scheduler.poolSize()
+    with Pool(processes=workers,initializer=openRasters,initargs=(layers,stack,vectorList)) as pool:
+        with tqdm.tqdm(total=len(parcels)) as progress:
+            for n in pool.imap_unordered(splitBatch,batches):
+                progress.update(n)
+
+# Copy a raster into a layer of the store a block of rows at a time, with source nodata set to the layer nodata.
+def storeLayer(layer,src,nodata):
+    for rows in blocks(layer.shape):
+        window = windows.Window(0,rows.start,layer.shape[1],rows.stop-rows.start)
+        img = src.read(1,window=window).astype(np.float32)
+        if src.nodata is not None:
+            if np.isnan(src.nodata):
+                img[np.isnan(img)] = nodata
+            else:
+                img[img==src.nodata] = nodata
+        layer[rows] = img
 
-        os.chdir(newDir)
+# Rasterize a batch of parcels on the store grid, returning (name, row, col, packed mask, width) for each.
+# Parcel windows are cut to the grid, dropping pixels outside every raster.
+def indexBatch(transform,shape,batch):
+    index = []
+    for uid,geoms in batch:
+        window = parcelWindow(geoms,transform)
+        row0,col0 = max(0,window.row_off),max(0,window.col_off)
+        row1,col1 = min(shape[0],window.row_off+window.height),min(shape[1],window.col_off+window.width)
+        if row1 <= row0 or col1 <= col0:
+            continue
+        clipped = windows.Window(col0,row0,col1-col0,row1-row0)
+        mask = features.geometry_mask(geoms,(row1-row0,col1-col0),windows.transform(clipped,transform),invert=True)
+        index.append(('{}.tif'.format(uid),row0,col0)+countystore.packMask(mask))
+    return index
 
-        # Iterative os command executed to cut raster to parcel lines.
-        print('Clipping raster')
-        for f in featIDs02:
-            os.system('gdalwarp -tr 1 1 -r near -ot Float64 -dstnodata %s -q -overwrite -cutline %s -cwhere U_ID=%s '
-                      '-crop_to_cutline --config GDALWARP_IGNORE_BAD_CUTLINE YES %s %s.tif' %(nodata,shp,f,im,f))
+# Build the county store in place of per-parcel tiffs.
+# Every raster is aligned to the landcover grid, by nearest resampling if it differs, and copied into one array,
+# then parcels are rasterized into the index in parallel batches.
+def buildStore(state,county,workers=None):
+    srcDir = 'C:/{}/{}/basedata'.format(state,county)
+    print(srcDir)
+    shp = os.path.join(srcDir,'{}_parcels.shp'.format(county))
+    countyDir = 'C://{}/{}/'.format(state,county)
+    layers = [(resampleRaster(os.path.join(srcDir,t)),dstDir,nodata) for t,dstDir,nodata in layerList(county)]
 
+    with rasterio.open(layers[0][0]) as ref:
+        transform,crs,shape = ref.transform,ref.crs,ref.shape
+    store = countystore.createStore(countyDir,[l[1] for l in layers],shape)
+    for i,(im,dstDir,nodata) in enumerate(layers):
+        print('Storing',dstDir)
+        with rasterio.open(im) as src:
+            if src.transform == transform and src.shape == shape and src.crs == crs:
+                storeLayer(store[i],src,nodata)
+            else:
+                with WarpedVRT(src,crs=crs,transform=transform,width=shape[1],height=shape[0],
+                               resampling=Resampling.nearest,nodata=nodata) as vrt:
+                    storeLayer(store[i],vrt,nodata)
+    store.flush()
+    del store
 
+    # Unique feature IDs and their geometries read once, then indexed in batches.
+    print('Reading shp features')
+    parcels = readParcels(shp)
+    batches = [parcels[i:i+batchSize] for i in range(0,len(parcels),batchSize)]
+
+    print('Indexing parcels')
+    if workers is None:
+        workers = scheduler.poolSize()
+    index = []
+    with Pool(processes=workers) as pool:
+        with tqdm.tqdm(total=len(batches)) as progress:
+            for batch in pool.imap(partial(indexBatch,transform,shape),batches):
+                index += batch
+                progress.update(1)
+    countystore.writeIndex(countyDir,[l[1] for l in layers],[float(l[2]) for l in layers],transform,crs.to_wkt(),index)
+
+
+# Execute main function.
+if __name__ == '__main__':
+    for c in countyList:
+        mainSplit(state,c)
@@ -0,0 +1,104 @@
+# Module for rotating scored parcels and dividers, shared by search.py and write.py.
+# Rotations match scipy.ndimage.rotate(reshape=True) in output shape and alignment.
+import numpy as np
+import cv2
+from scipy import special
+from scipy.ndimage import rotate
+from scratch import scratchArray, blocks
+
+# Interpolation options for rotateStack.
+# 'cubic' keeps the previous scipy spline rotation in float64.
+interpolations = {
+                  'nearest':cv2.INTER_NEAREST,
+                  'bilinear':cv2.INTER_LINEAR,
+                  'cubic':None
+                  }
+
+# Rotated stacks and transforms of the current parcel.
+# Cleared by clearCache once the parcel has been searched and written.
+stackCache = {}
+transformCache = {}
+
+# Set the number of threads used by the OpenCV warp, e.g. 1 when run inside a process pool.
+def setThreads(threads):
+    cv2.setNumThreads(threads)
+
+# Remove all cached rotations, called at the end of each parcel.
+def clearCache():
+    stackCache.clear()
+    transformCache.clear()
+
+# Return the affine transform from a rotated frame to the original raster, and the rotated shape.
+# The matrix is in OpenCV (column,row) order and maps rotated pixels to original pixels.
+def rotationTransform(shape,angle):
+    key = (tuple(shape[:2]),angle)
+    if key not in transformCache:
+        c,s = special.cosdg(angle),special.sindg(angle)
+        rotMatrix = np.array([[c,s],[-s,c]])
+
+        # Shape of the rotated frame, as computed by scipy.ndimage.rotate.
+        iy,ix = shape[:2]
+        outBounds = rotMatrix@[[0,0,iy,iy],[0,ix,0,ix]]
+        outShape = (np.ptp(outBounds,axis=1)+0.5).astype(int)
+
+        # Centers of both frames are aligned.
+        offset = (np.asarray(shape[:2])-1)/2-rotMatrix@((outShape-1)/2)
+        transform = np.array([[rotMatrix[1,1],rotMatrix[1,0],offset[1]],
+                              [rotMatrix[0,1],rotMatrix[0,0],offset[0]]])
+        transformCache[key] = (transform,tuple(outShape))
+    return transformCache[key]
+
+# Rotate the scored image and dividers together by angle (degrees).
+# Out-of-bounds pixels are -1 in the score and 0 in the dividers, as before.
+# Boolean dividers are warped as 100 (contiguous) and -1000 (divider), the values scoreParcel used to write.
+# The rotated dividers are returned as a boolean mask of contiguous pixels, as search.dividerMask gives.
+def rotateStack(img,dividers,angle,interpolation='bilinear'):
+    key = (id(img),id(dividers),angle,interpolation)
+    entry = stackCache.get(key)
+    if entry is not None and entry[0] is img and entry[1] is dividers:
+        return entry[2],entry[3]
+
+    if interpolations[interpolation] is None:
+        divValues = dividers
+        if dividers.dtype == bool:
+            divValues = np.where(dividers,np.float32(100),np.float32(-1000))
+        rotated = rotate(img,angle,reshape=True,mode='constant',cval=-1)
+        rotatedDiv = rotate(divValues,angle,reshape=True)
+        rotatedDiv = (rotatedDiv>-1)&(rotatedDiv!=0)
+    else:
+        rotated,rotatedDiv = warpRasters(img,dividers,angle,interpolation)
+
+    stackCache[key] = (img,dividers,rotated,rotatedDiv)
+    return rotated,rotatedDiv
+
+# Warp the scored image and dividers for rotateStack, each by its own multithreaded float32 warp.
+# OpenCV's single-channel warp is faster and closer to exact bilinear interpolation than a two-channel one.
+# Outputs are scratch arrays, memory-mapped while the parcel is windowed,
+# and divider values and the rotated divider mask are converted a block of rows at a time.
+def warpRasters(img,dividers,angle,interpolation):
+    transform,outShape = rotationTransform(img.shape,angle)
+    flags = interpolations[interpolation]|cv2.WARP_INVERSE_MAP
+    divValues = scratchArray(dividers.shape,np.float32)
+    for rows in blocks(dividers.shape):
+        if dividers.dtype == bool:
+            divValues[rows] = np.where(dividers[rows],np.float32(100),np.float32(-1000))
+        else:
+            divValues[rows] = dividers[rows]
+
+    rotated = scratchArray(outShape,np.float32)
+    warped = scratchArray(outShape,np.float32)
+    cv2.warpAffine(np.asarray(img,dtype=np.float32),transform,(outShape[1],outShape[0]),dst=rotated,flags=flags,
+                   borderMode=cv2.BORDER_CONSTANT,borderValue=-1)
+    cv2.warpAffine(np.asarray(divValues),transform,(outShape[1],outShape[0]),dst=warped,flags=flags,
+                   borderMode=cv2.BORDER_CONSTANT,borderValue=0)
+    rotatedDiv = scratchArray(outShape,bool)
+    for rows in blocks(outShape):
+        rotatedDiv[rows] = (warped[rows]>-1)&(warped[rows]!=0)
+    return rotated,rotatedDiv
+
+# Return a raster from the rotated frame of angle back in the original frame of shape.
+# Nearest interpolation is used, so no values are blended.
+def unrotate(rotated,shape,angle):
+    transform,outShape = rotationTransform(shape,angle)
+    return cv2.warpAffine(np.ascontiguousarray(rotated,dtype=np.float32),transform,(shape[1],shape[0]),
+                          flags=cv2.INTER_NEAREST,borderMode=cv2.BORDER_CONSTANT,borderValue=0)
@@ -0,0 +1,119 @@
+# Module for scheduling parcels onto the combfunc process pool by estimated cost.
+import os
+import queue
+import collections
+import numpy as np
+import tifffile as tiff
+import countystore
+
+# Estimated peak bytes per pixel of a parcel's bounding box while it is scored and searched.
+# openTiffs holds five float32 layers, slope and aspect as read, up to float64, and a uint8 landcover (37),
+# scoreLayers writes the float32 score, boolean dividers and valid mask (6) with only a chunk of temporaries,
+# and the search holds six rotated float32 score and boolean divider pairs (30) in frames up to twice the area (60),
+# plus the lookup tables kept for all six rotations (6x 2x 20 = 240) and blob labels for the one being searched (2x 4 = 8).
+bytesPerPixel = 37+6+60+240+8
+
+# Estimated peak bytes per pixel of a parcel run windowed, when only write.overlay's frames are held in memory,
+# plus a fixed allowance for blocks, candidate arrays and the page cache of the scratch arrays in use.
+windowedBytesPerPixel = 16
+windowedBytes = 512*1024**2
+
+# Estimated extra bytes per pixel of a parcel searched on threads, which labels the blobs of all six rotations at once.
+threadedBytesPerPixel = 5*2*4
+
+# Return the estimated peak bytes of a parcel run windowed, from its in-memory estimate.
+def windowedPeak(peak):
+    return peak/bytesPerPixel*windowedBytesPerPixel+windowedBytes
+
+# Return the memory budget for running parcels: 70% of physical memory, or 16 GB if it can't be read.
+def memoryBudget():
+    try:
+        return int(os.sysconf('SC_PHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')*0.7)
+    except (AttributeError,ValueError,OSError):
+        return 16*1024**3
+
+# Return the number of cores available to this process.
+def poolSize():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# Estimate the relative processing cost and peak memory of a parcel from its landcover tiff, or stacked first page.
+# Scoring touches every pixel of the footprint's bounding box.
+# The search scales with the number of candidate rectangles, about (valid/stride^2)^2,
+# each labelling blobs over up to the maximum AOI area.
+def parcelCost(path,stride=70,maxAcres=40):
+    img = tiff.imread(path,key=0)
+    return estimateCost(os.path.basename(path),img.size,np.count_nonzero(img>0),stride,maxAcres)
+
+# Estimate the cost and peak memory of a parcel in the county store at srcDir, from its landcover inside its mask.
+def storeCost(srcDir,name,stride=70,maxAcres=40):
+    layers,nodata,mask = countystore.parcelLayers(srcDir,name)
+    lc = [layers[d] for d in layers if d.endswith('_landcover')][0]
+    return estimateCost(name,mask.size,np.count_nonzero((lc>0)&mask),stride,maxAcres)
+
+# Returns the name, cost and peak memory of a parcel of size pixels, valid of them positive landcover.
+def estimateCost(name,size,valid,stride=70,maxAcres=40):
+    maxM = maxAcres/0.000247105381467165
+    candidates = (valid/stride**2)**2
+    cost = size+candidates*min(valid,maxM)
+    return name,cost,size*bytesPerPixel
+
+# Group parcels into pool tasks, most expensive first.
+# Parcels above batchCost are their own task; cheaper parcels are batched until a task reaches batchCost.
+# By default batchCost is set so there are about 64 tasks per worker.
+def batchParcels(costs,workers,batchCost=None):
+    ordered = sorted(costs.items(),key=lambda item:item[1],reverse=True)
+    if batchCost is None:
+        batchCost = sum(costs.values())/(workers*64)
+    tasks = []
+    batch = []
+    batchSum = 0
+    for name,cost in ordered:
+        if cost >= batchCost:
+            tasks.append([name])
+            continue
+        batch.append(name)
+        batchSum += cost
+        if batchSum >= batchCost:
+            tasks.append(batch)
+            batch = []
+            batchSum = 0
+    if batch:
+        tasks.append(batch)
+    return tasks
+
+# Return the parcels costing more than one worker's even share of the whole run.
+# On one core each would still be running after the rest are done, so they are also searched on threads.
+def largeParcels(costs,workers):
+    share = sum(costs.values())/workers
+    return {name for name,cost in costs.items() if workers > 1 and cost > share}
+
+# Returns the estimated peak bytes of a parcel searched on threads, from its in-memory estimate.
+def threadedPeak(peak):
+    return peak/bytesPerPixel*(bytesPerPixel+threadedBytesPerPixel)
+
+# Run tasks on pool, yielding results as they complete.
+# A task only starts while the estimated memory of the running tasks stays within budget.
+# Tasks start in order, and a waiting task starts alone once nothing else is running,
+# so large parcels run with fewer neighbours instead of being skipped.
+def admitTasks(pool,func,tasks,memory,budget,workers):
+    done = queue.Queue()
+    pending = collections.deque(zip(tasks,memory))
+    running = 0
+    inUse = 0
+    while pending or running:
+        while pending and running < workers and (running == 0 or inUse+pending[0][1] <= budget):
+            task,mem = pending.popleft()
+            pool.apply_async(func,(task,),
+                             callback=lambda result,mem=mem:done.put((result,mem)),
+                             error_callback=lambda error,mem=mem:done.put((error,mem)))
+            running += 1
+            inUse += mem
+        result,mem = done.get()
+        running -= 1
+        inUse -= mem
+        if isinstance(result,BaseException):
+            raise result
+        yield result
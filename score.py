@@ -2,7 +2,6 @@
 
 import tifffile as tiff
 import numpy as np
-from scipy import stats
 from search import sizeCheck
 import os
 import cv2
@@ -10,34 +9,86 @@ import operator
 import matplotlib.pyplot as plt
 import random
 import itertools
+import scorecache
+import scratch
+import countystore
+from concurrent.futures import ThreadPoolExecutor
 
 # Avoid errors for division by 0.
 np.seterr(divide='ignore', invalid='ignore')
 np.warnings.filterwarnings('ignore')
 
+# Weights applied to each layer score before they are combined.
+# Part of the score cache key, so changing a weight rescores every parcel.
+weights = {
+           'landcover':0.8,
+           'topo':1.0,
+           'dtr':0.5,
+           'dtb':1.5,
+           'dt3p':0.8,
+           'dtw':1.0,
+           'dtp':1.0
+           }
+
 # Responsible for returning county directory within the state.
 # Currently, the state must be edited here. This must be changed.
 def getSourceDir(county):
     srcDir = 'D://new_york/{}'.format(county)
     return srcDir
 
+# Directory of stacked parcels written by rastersplit, one multi-page tiff per parcel.
+# A parcel with a stacked file is read from it in place of the per-layer directories.
+stackDir = 'stack'
+
+# Return the stacked file of a parcel, or None if it is only split into per-layer directories.
+def stackPath(county,imgName):
+    path = os.path.join(getSourceDir(county),stackDir,imgName)
+    if os.path.isfile(path):
+        return path
+    return None
+
+# Return the input files of a parcel: the county store holding it, its stacked file or one tiff per layer.
+def parcelPaths(county,imgName):
+    if countystore.hasParcel(getSourceDir(county),imgName):
+        return countystore.storeFiles(getSourceDir(county))
+    path = stackPath(county,imgName)
+    if path is not None:
+        return [path]
+    src = getSourceDir(county)
+    return [os.path.join(src,d,imgName) for d in layerDirs(county)]
+
+# Return the georeferenced landcover tiff of a parcel; a stacked file's first page is landcover.
+def landcoverPath(county,imgName):
+    path = stackPath(county,imgName)
+    if path is not None:
+        return path
+    return os.path.join(getSourceDir(county),'{}_landcover'.format(county),imgName)
+
 # Returns the list of available tiffs, sorted from largest to smallest
 # Sorting is used to make the best use of multiprocessing
-def getImgList(directory,county):
+def getImgList(directory,county,maxSize=None):
     tifList = {}
 
-    # List is derived from the tiffs in the county directory
-    landcoverPath = os.path.join(directory,'{}_aspect'.format(county))
-    for file in os.listdir(landcoverPath):
-        if file.endswith(".tif"):
-            path = os.path.join(landcoverPath,file)
-            size = os.path.getsize(path)
-
-            # Write to dictionary with file name and size
-            tifList.update({file:size})
-
-    # Remove TIFFs over a certain size; too big to work efficiently in local memory
-    tifList = {key: val for key, val in tifList.items() if val <= 222767406}
+    # List is derived from the county store, if there is one, with sizes as Float64 tiffs
+    # Otherwise from the tiffs in the county directory, the stacked parcels if there are any
+    if countystore.openStore(directory) is not None:
+        tifList = countystore.parcelSizes(directory)
+    else:
+        listPath = os.path.join(directory,stackDir)
+        if not os.path.isdir(listPath):
+            listPath = os.path.join(directory,'{}_aspect'.format(county))
+        for file in os.listdir(listPath):
+            if file.endswith(".tif"):
+                path = os.path.join(listPath,file)
+                size = os.path.getsize(path)
+
+                # Write to dictionary with file name and size
+                tifList.update({file:size})
+
+    # Optionally remove TIFFs over a certain size, e.g. 222767406 bytes.
+    # By default every parcel is kept; combfunc admits large parcels within its memory budget instead.
+    if maxSize is not None:
+        tifList = {key: val for key, val in tifList.items() if val <= maxSize}
 
     # Test random sample of parcels, uncomment the line below to use
     # tifList = dict(random.sample(tifList.items(),100))
@@ -55,27 +106,37 @@ def getImgList(directory,county):
     tifList = tifList.keys()
     return tifList
 
+# Standard landcover scoring, indexed by landcover class.
+landcoverScores = np.array([
+                            0,      # Nodata
+                            -1000,  # Water
+                            -1000,  # Wetlands
+                            90,     # Trees
+                            100,    # Grass
+                            100,    # Barren
+                            -1750,  # Buildings
+                            -1750   # Impervious
+                            ],dtype=np.float32)
+
+# Return landcover classes as uint8.
+# Errors and nodata outside classes 0-7 are read as 0, the nodata class.
+def landcoverClasses(landcover):
+    return np.where((landcover>=0)&(landcover<=7),landcover,0).astype(np.uint8)
+
 # Input landcover classes tiff from DeepUNET,reclassify into scores.
 def landcoverScore(landcover):
-    LCs = landcover
-
-    #Standard landcover scoring
-    LCs[LCs>7]=0  # Read all errors as nodata
-    LCs[LCs==1]=-1000  # Water
-    LCs[LCs==2]=-1000  # Wetlands
-    LCs[LCs==3]=90    # Trees
-    LCs[LCs==4]=100   # Grass
-    LCs[LCs==5]=100   # Barren
-    LCs[LCs==6]=-1750  # Buildings
-    LCs[LCs==7]=-1750   # Impervious
-    return LCs
+    LCs = landcoverClasses(landcover)
+    return landcoverScores[LCs]
 
 # Input Distance to Roads (DTR) tiff, return a score.
-def roadScore(dtr):
+# The maximum distance is taken from dtr unless given, as scoreLayers does for each chunk.
+def roadScore(dtr,maxDist=None):
     DTRs = dtr
+    if maxDist is None:
+        maxDist = DTRs.max()
 
     # Invert score to make the area closest to roads more desirable.
-    DTRs = (100-(DTRs/DTRs.max())*100)
+    DTRs = (100-(DTRs/maxDist)*100)
 
     # Reclassify out-of-bounds pixels.
     DTRs[DTRs>99.9]=-10
@@ -99,11 +160,13 @@ def buildingScore(dtb):
     return DTBs
 
 # Input Distance to 3phase (DT3P), return a score.
-def phaseScore(dt3p):
+def phaseScore(dt3p,maxDist=None):
     DT3Ps = dt3p
+    if maxDist is None:
+        maxDist = DT3Ps.max()
 
     # Invert score to make the are closest to 3phase more desireable.
-    DT3Ps = (100-(DT3Ps/DT3Ps.max())*100)
+    DT3Ps = (100-(DT3Ps/maxDist)*100)
 
     # Reclassify out-of-bounds.
     DT3Ps[DT3Ps>99.9]=-10
@@ -127,11 +190,13 @@ def waterScore(dtw):
     return DTWs
 
 # Input Distance to Parcel boundaries (DTP), return a score.
-def boundaryScore(dtp):
+def boundaryScore(dtp,maxDist=None):
     DTPs = dtp
+    if maxDist is None:
+        maxDist = DTPs.max()
 
     # Invert score to make the area closest to boundaries more desirable.
-    DTPs = (100-(DTPs/DTPs.max())*100)
+    DTPs = (100-(DTPs/maxDist)*100)
 
     # Reclassify out-of-bounds.
     DTPs[DTPs>99.9]=-10
@@ -179,150 +244,199 @@ def accScore(acc):
     ACCs[ACCs>0]=0
     return ACCs
 
-# Return a binary array of North-facing slopes.
-def findNorth(asp):
-    AS = asp
-    north = (AS<37.5).astype(int) +  (AS>0).astype(int)
-    north = (north==2).astype(int) + (AS>325.5).astype(int)
-    return north
-
-# Return a binary array of East-facing slopes.
-def findEast(asp):
-    AS = asp
-    east = (AS>37.5).astype(int) + (AS<127.5).astype(int)
-    east = (east==2).astype(int)
-    return east
-
-# Return a binary array of West-facing slopes.
-def findWest(asp):
-    AS = asp
-    west = (AS>235.5).astype(int) + (AS<325.5).astype(int)
-    west = (west==2).astype(int)
-    return west
-
-# Return a binary array of South-facing slopes.
-def findSouth(asp):
-    AS = asp
-
-    #Eliminate -1 (flat) in aspect
-    AS[AS<0]=180
-    south = (AS<=235.5).astype(int) + (AS>=127.5).astype(int)
-    south = (south==2).astype(int)
-    return south
-
-# Return a binary array of slopes under 5 degrees.
-def findShallow(sl):
-    SL = sl
-    flat = (SL<=2.86).astype(int) + (SL>0.0).astype(int)
-    flat = (flat==2).astype(int)
-    return flat
-
-# Return a binary array of slopes between 5 and 10 degrees.
-def findMedium(sl):
-    SL = sl
-    medium = (SL<=6.84).astype(int) + (SL>2.86).astype(int)
-    medium = (medium==2).astype(int)
-    return medium
-
-# Return a binary array of slopes over 10 degrees.
-def findSteep(sl):
-    SL = sl
-    steep = (SL>6.84).astype(int)
-    return steep
-
-# Find North-facing slopes over 5, assign a negative score.
-def steepNorth(north,medium,steep):
-    target = north+medium+steep
-    target = ((target==2).astype(int))*-5000
-    return target
-
-# Find North-facing slopes under 5, assign a moderate value.
-def flatNorth(north,flat):
-    target = north+flat
-    target = ((target==2).astype(int))*75
-    return target
-
-# Find East and West facing slopes over 10, assign a negative value.
-def steepLateral(east, west, steep):
-    target = east+west+steep
-    target = ((target==2).astype(int))*-5000
-    return target
-
-# Find East and West facing slopes between 5 and 10, assign a moderate value.
-def mediumLateral(east,west,medium):
-    target = east+west+medium
-    target = ((target==2).astype(int))*75
-    return target
-
-# Find East and West facing slopes under 5, assign a strong value.
-def flatLateral(east,west,medium):
-    target = east+west+medium
-    target = ((target==2).astype(int))*90
-    return target
-
-# Find South facing slopes over 10, assign a weak value.
-def steepSouth(south,steep):
-    target = south+steep
-    target = ((target==2).astype(int))*-5000
-    return target
-
-# Find South facing slopes between 5 and 10, assign a strong value.
-def mediumSouth(south,medium):
-    target = south+medium
-    target = ((target==2).astype(int))*100
-    return target
-
-# Find South facing slopes under 5, assign a strong value.
-def flatSouth(south,flat):
-    target = south+flat
-    target = ((target==2).astype(int))*95
-    return target
-
-# Run all topo functions and combine outputs.
+# Aspect bin edges, binned as np.searchsorted(side='right') would.
+# Exactly 0, 37.5 and 325.5 fall in bins of their own, 127.5 and 235.5 fall with South.
+# NaN and inf fall past the last edge.
+aspectEdges = np.array([0,np.nextafter(np.float32(0),np.float32(1)),
+                        37.5,np.nextafter(np.float32(37.5),np.float32(360)),
+                        127.5,np.nextafter(np.float32(235.5),np.float32(360)),
+                        325.5,np.nextafter(np.float32(325.5),np.float32(360)),
+                        np.inf],dtype=np.float32)
+
+# The same edges for aspect binned in float64.
+aspectEdges64 = np.array([0,np.nextafter(0.0,1.0),
+                          37.5,np.nextafter(37.5,360.0),
+                          127.5,np.nextafter(235.5,360.0),
+                          325.5,np.nextafter(325.5,360.0),
+                          np.inf])
+
+# Aspect class of each aspect bin: 0 none, 1 North, 2 East or West, 3 South.
+# -1 (flat) in aspect is counted as South-facing.
+aspectClasses = np.array([3,0,1,0,2,3,2,0,1,0],dtype=np.intp)
+
+# Slope bin edges, binned as np.searchsorted(side='left') would.
+# Bins are 0 none, 1 under 5 degrees, 2 between 5 and 10 degrees, 3 over 10 degrees, 4 NaN.
+# Slopes in float64 are binned on the thresholds themselves.
+# For float32 slopes, each edge is the largest float32 at or below the float64 threshold,
+# so they bin as the same values in float64 would; float32(6.84) itself is above 6.84.
+slopeThresholds = np.array([0,2.86,6.84,np.inf])
+slopeEdges = slopeThresholds.astype(np.float32)
+slopeEdges = np.where(slopeEdges>slopeThresholds,np.nextafter(slopeEdges,np.float32(-np.inf)),slopeEdges)
+
+# Topo score by aspect class (rows) and slope bin (columns).
+# Pixels without an aspect or slope class are out-of-bounds.
+topoScores = np.array([
+                       [-10,-10,-10,-10,-10],     # Out-of-bounds
+                       [-10,75,-5000,-5000,-10],  # North: moderate under 5, negative over 5
+                       [-10,90,75,-5000,-10],     # East and West: strong under 5, moderate 5-10, negative over 10
+                       [-10,95,100,-5000,-10]     # South: strong under 10, negative over 10
+                       ],dtype=np.float32)
+
+# Topo score by aspect bin and slope bin, flattened for topoScore.
+topoTable = topoScores[aspectClasses].ravel()
+
+# Return the bin of each value, the same as np.searchsorted(edges,values,side).
+# One comparison per edge is much faster than a binary search per value; NaN falls past the last edge.
+def binValues(values,edges,side):
+    compare = np.less if side == 'right' else np.less_equal
+    bins = np.full(values.shape,len(edges),dtype=np.uint8)
+    for e in edges:
+        bins -= compare(values,e)
+    return bins
+
+# Bin aspect and slope once, then look up the topo score of every pixel.
+# Float32 layers are binned on the float32 edges, any other layer on the float64 edges, so values are never rounded.
 def topoScore(asp,sl):
-    north = findNorth(asp)
-    east = findEast(asp)
-    west = findWest(asp)
-    south = findSouth(asp)
-
-    shallow = findShallow(sl)
-    medium = findMedium(sl)
-    steep = findSteep(sl)
-
-    # Combine scores into new array portraying all topo data.
-    topo=(
-        steepNorth(north,medium,steep)+
-        flatNorth(north,shallow)+
-        steepLateral(east,west,steep)+
-        mediumLateral(east,west,medium)+
-        flatLateral(east,west,shallow)+
-        steepSouth(south,steep)+
-        mediumSouth(south,medium)+
-        flatSouth(south,shallow)
-        )
+    aspect = binValues(asp,aspectEdges if asp.dtype == np.float32 else aspectEdges64,'right')
+    slope = binValues(sl,slopeEdges if sl.dtype == np.float32 else slopeThresholds,'left')
+    return topoTable[aspect*np.uint8(len(slopeEdges)+1)+slope]
+
+# Pixels scored per chunk by scoreLayers, so every layer of a chunk stays in cache.
+chunkPixels = 1<<16
+
+# Boolean mask of the pixels of a layer holding data.
+def hasData(layer,nodata):
+    if np.isnan(nodata):
+        return ~np.isnan(layer)
+    return layer!=nodata
+
+# Score, weight and combine all layers in one pass over the parcel, a chunk of rows at a time.
+# Layers and their nodata values are keyed as in layerDirs, and layers are already cut to the same shape.
+# Distance maxima are taken over the whole parcel first, so every chunk scores as the whole parcel would.
+# Pixels where every layer is nodata lie outside the parcel; they are invalid, scored -1 and never contiguous.
+# Layers may be memory maps of any dtype, as openTiffs gives while windowed; the outputs are then scratch arrays.
+# Given a parcel mask, as for a parcel in the county store, every layer is read as nodata outside it.
+# With threads above 1, chunks are scored on a thread pool.
+def scoreLayers(layers,nodata,county,threads=1,mask=None):
+    lcKey = '{}_landcover'.format(county)
+    topo = topoLayers(county)
+    dim0,dim1 = layers[lcKey].shape
+    if mask is None:
+        maxima = {d:np.float32(layers[d].max()) for d in ('dtr','dt3p','dtp')}
+    else:
+        maxima = {d:np.float32(np.max(layers[d],where=mask,initial=nodata[d])) for d in ('dtr','dt3p','dtp')}
+    totalScore = scratch.scratchArray((dim0,dim1),np.float32)
+    dividers = scratch.scratchArray((dim0,dim1),bool)
+    valid = scratch.scratchArray((dim0,dim1),bool)
+    step = max(1,chunkPixels//dim1)
+
+    def scoreChunk(r0):
+        rows = slice(r0,r0+step)
+
+        # Each chunk is read as a copy, so scoring never changes the layers.
+        # Slope and aspect keep their precision, e.g. float64, for topoScore's bins; other layers are float32.
+        LCs = landcoverClasses(layers[lcKey][rows])
+        chunk = {d:np.array(layers[d][rows],dtype=np.float32) for d in layers if d != lcKey}
+        for d in topo:
+            chunk[d] = np.array(layers[d][rows],dtype=np.result_type(layers[d].dtype,np.float32))
+        if mask is not None:
+            outside = ~mask[rows]
+            LCs[outside] = nodata[lcKey]
+            for d in chunk:
+                chunk[d][outside] = nodata[d]
+        validChunk = hasData(LCs,nodata[lcKey])
+        for d in chunk:
+            validChunk |= hasData(chunk[d],nodata[d])
+
+        LC = landcoverScore(LCs)*weights['landcover']
+        TOPO = topoScore(chunk['{}_aspect'.format(county)],chunk['{}_slope'.format(county)])*weights['topo']
+        DTR = roadScore(chunk['dtr'],maxima['dtr'])*weights['dtr']
+        DTB = buildingScore(chunk['dtb'])*weights['dtb']
+        DT3P = phaseScore(chunk['dt3p'],maxima['dt3p'])*weights['dt3p']
+        DTW = waterScore(chunk['dtw'])*weights['dtw']
+        DTP = boundaryScore(chunk['dtp'],maxima['dtp'])*weights['dtp']
+
+        # All scores combined, out of bounds replaced with unique value
+        totalScore[rows] = np.where(validChunk,LC + TOPO + DTR + DTB + DT3P + DTP + DTW,np.float32(-1))
+
+        # Boolean mask of contiguous areas, undesirable areas are False
+        dividers[rows] = ((DTW + DTR)>=0)&validChunk
+        valid[rows] = validChunk
+
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(scoreChunk,range(0,dim0,step)))
+    else:
+        for r0 in range(0,dim0,step):
+            scoreChunk(r0)
+    return totalScore,dividers,valid
+
+# Returns the directories of the input layers, landcover first.
+def layerDirs(county):
 
-    #Reclassify out-of-bounds
-    topo[topo==0]=-10
-    return topo
+    # Rail-roads, driveways, and precipitation accumulation no longer used.
+    return ['{}_landcover'.format(county),
+            '{}_slope'.format(county),
+            '{}_aspect'.format(county),
+            'dtr',
+            'dtb',
+            'dt3p',
+            'dtw',
+            'dtp'
+            # 'dtrr'
+            # ,'dtd'
+            # ,'acc'
+            ]
+
+# Returns the directories of the slope and aspect layers, binned by topoScore in the precision they are read in.
+def topoLayers(county):
+    return ['{}_slope'.format(county),'{}_aspect'.format(county)]
+
+# Returns the nodata value of each input layer as rastersplit writes it, -1 for slope and 0 otherwise.
+def layerNodata(county):
+    nodata = {d:0.0 for d in layerDirs(county)}
+    nodata['{}_slope'.format(county)] = -1.0
+    return nodata
+
+# Read a layer tiff, returning the array and its GDAL_NODATA value, or None if it has none.
+def readLayer(path):
+    with tiff.TiffFile(path) as tif:
+        return readPage(tif,0)
+
+# Read page index of an open tiff, returning the array and its GDAL_NODATA value, or None if it has none.
+# While windowed, the page is memory-mapped, or decoded into a scratch array if it isn't stored contiguously.
+def readPage(tif,index):
+    page = tif.pages[index]
+    tag = page.tags.get('GDAL_NODATA')
+    if not scratch.windowed():
+        img = page.asarray()
+    else:
+        try:
+            img = tiff.memmap(tif.filehandle.path,page=index,mode='r')
+        except ValueError:
+            img = scratch.scratchArray(page.shape,page.dtype)
+            page.asarray(out=img)
+    if tag is None:
+        return img,None
+    return img,float(str(tag.value).strip('\x00 '))
 
 #Opens tiff and checks if 'landcover' is a useable size
+#Also returns the nodata value of each layer, from its tiff or as rastersplit writes it
+#A stacked parcel is opened once, with its layers read from the pages named by their ImageDescription
 def openTiffs(county,imgName,minAcres,maxAcres):
+    path = stackPath(county,imgName)
+    if path is None:
+        return readTiffs(county,imgName,minAcres,maxAcres,None)
+    with tiff.TiffFile(path) as tif:
+        return readTiffs(county,imgName,minAcres,maxAcres,tif)
+
+# Reads the layers of openTiffs, from the per-layer tiffs or from the open stacked file tif.
+def readTiffs(county,imgName,minAcres,maxAcres,tif):
     src = getSourceDir(county)
-
-    # Rail-roads, driveways, and precipitation accumulation no longer used.
-    dataDict = {
-                '{}_landcover'.format(county):'',
-                '{}_slope'.format(county):'',
-                '{}_aspect'.format(county):'',
-                'dtr':'',
-                'dtb':'',
-                'dt3p':'',
-                'dtw':'',
-                'dtp':''
-                # 'dtrr':''
-                # ,'dtd':''
-                # ,'acc':''
-                }
+    dataDict = {d:'' for d in layerDirs(county)}
+    nodata = layerNodata(county)
+    if tif is not None:
+        pages = {page.description:i for i,page in enumerate(tif.pages)}
 
     # Empty lists to record any size variance among input tiffs.
     dim0 = []
@@ -330,14 +444,26 @@ def openTiffs(county,imgName,minAcres,maxAcres):
 
     # Check if parcel contains enough viable area for an AOI
     for d in dataDict:
-        dPath = os.path.join(src,'{}/{}'.format(d,imgName))
-        dImg = tiff.imread(dPath).astype('float64')
+        if tif is None:
+            dImg,dNodata = readLayer(os.path.join(src,'{}/{}'.format(d,imgName)))
+        else:
+            dImg,dNodata = readPage(tif,pages[d])
+        if dNodata is not None:
+            nodata[d] = dNodata
 
         # If viable area is insufficient, return all 0's.
+        # Landcover classes are kept as uint8, slope and aspect as read, and all other layers as float32.
+        # Landcover errors and nodata outside classes 0-7 are read as 0, the nodata class.
+        # While windowed, layers are left as read and converted a chunk at a time by scoreLayers.
         if d == '{}_landcover'.format(county):
             useable,minM,maxM = sizeCheck(minAcres,maxAcres,dImg)
             if useable == False:
-                return 0,0,0
+                return 0,0,0,0
+            nodata[d] = 0.0
+            if not scratch.windowed():
+                dImg = landcoverClasses(dImg)
+        elif not scratch.windowed() and d not in topoLayers(county):
+            dImg = dImg.astype(np.float32,copy=False)
 
         dim0.append(dImg.shape[0])
         dim1.append(dImg.shape[1])
@@ -345,46 +471,61 @@ def openTiffs(county,imgName,minAcres,maxAcres):
     dim0 = min(dim0)
     dim1 = min(dim1)
     # If viable area is sufficient, return array size.
-    return dataDict,dim0,dim1
+    return dataDict,nodata,dim0,dim1
+
+# Takes the layers of a parcel in the county store as views of its window, with its nodata values and mask.
+# Checks if 'landcover' inside the mask is a useable size, returning all 0's if not, as openTiffs does.
+def storeLayers(county,imgName,minAcres,maxAcres):
+    dataDict,nodata,mask = countystore.parcelLayers(getSourceDir(county),imgName)
+    useable,minM,maxM = sizeCheck(minAcres,maxAcres,dataDict['{}_landcover'.format(county)],mask=mask)
+    if useable == False:
+        return 0,0,0,0,0
+    nodata['{}_landcover'.format(county)] = 0.0
+    return dataDict,nodata,mask,mask.shape[0],mask.shape[1]
 
 # Master function that runs previous scoring functions, resizes arrays, and combines after weighting.
-def scoreParcel(county,imgName,minAcres,maxAcres):
-
-    # Calls openTiffs to check the viable area within parcel.
+# Scored parcels are kept in the score cache at cacheDir, by default the county's 'scorecache' directory.
+# Set cacheDir to False to always score from the tiffs.
+# Threads sets how many threads scoreLayers uses.
+# Returns the scored parcel, the contiguity mask (dividers), and the mask of valid pixels inside the parcel.
+# While the parcel is windowed (see scratch.py), layers are memory-mapped and scored into scratch arrays.
+def scoreParcel(county,imgName,minAcres,maxAcres,cacheDir=None,threads=1):
+
+    # A cached parcel is returned without opening its tiffs.
+    if cacheDir is None:
+        cacheDir = os.path.join(getSourceDir(county),'scorecache')
+    if cacheDir:
+        key = scorecache.cacheKey(imgName,parcelPaths(county,imgName),weights)
+        cached = scorecache.loadScores(cacheDir,key)
+        if cached is not None:
+            return cached
+
+    # Calls openTiffs, or storeLayers for a parcel in the county store, to check the viable area within parcel.
     # If insufficient, scores are not calculated.
-    dataDict,dim0,dim1 = openTiffs(county,imgName,minAcres,maxAcres)
+    mask = None
+    if countystore.hasParcel(getSourceDir(county),imgName):
+        dataDict,nodata,mask,dim0,dim1 = storeLayers(county,imgName,minAcres,maxAcres)
+    else:
+        dataDict,nodata,dim0,dim1 = openTiffs(county,imgName,minAcres,maxAcres)
     if dataDict == 0:
-        totalScore = np.zeros((1,1))
-        dividers = np.zeros((1,1))
-        return totalScore, dividers
+        totalScore = np.zeros((1,1),dtype=np.float32)
+        dividers = np.zeros((1,1),dtype=bool)
+        valid = np.zeros((1,1),dtype=bool)
+        return totalScore, dividers, valid
 
     # Calls scoring functions
     # Resizes by array indexing to size of smallest tiff
-    # Multiplies by weight
-    LC = landcoverScore(dataDict['{}_landcover'.format(county)][0:dim0,0:dim1])*0.8
-    TOPO = topoScore(dataDict['{}_aspect'.format(county)][0:dim0,0:dim1],dataDict['{}_slope'.format(county)][0:dim0,0:dim1])*1.0
-    DTR = roadScore(dataDict['dtr'][0:dim0,0:dim1])*0.5
-    DTB = buildingScore(dataDict['dtb'][0:dim0,0:dim1])*1.5
-    DT3P = phaseScore(dataDict['dt3p'][0:dim0,0:dim1])*0.8
-    DTW = waterScore(dataDict['dtw'][0:dim0,0:dim1])*1.0
-    DTP = boundaryScore(dataDict['dtp'][0:dim0,0:dim1])*1.0
+    # Multiplies by weight, scores are float32 throughout
+    layers = {d:dataDict[d][0:dim0,0:dim1] for d in dataDict}
+    if mask is not None:
+        mask = mask[0:dim0,0:dim1]
+    totalScore,dividers,valid = scoreLayers(layers,nodata,county,threads,mask)
     # rails = railScore(dataDict['dtrr'][0:dim0,0:dim1])*1.0
     # drives = drivewayScore(dataDict['dtd'][0:dim0,0:dim1])*1.0
     # acc = accScore(dataDict['acc'][0:dim0,0:dim1])*1.0
 
-    # All scores combined
-    totalScore = LC + TOPO + DTR + DTB + DT3P + DTP + DTW
-
-    # Undesirable areas masked with negative values
-    dividers = DTW + DTR
-    dividers[dividers<0]=-1000
-    dividers[dividers>=0]=100
-
     # To run with no dividers, uncomment below.
-    # dividers = np.ones((dividers.shape))
-
-    #Replace all out of bound with unique value
-    totalScore[totalScore==(stats.mode(totalScore,axis=None))[0]] = -1
+    # dividers = valid.copy()
 
     # Options for sample viewing.
     # fig,ax = plt.subplots(1)
@@ -395,4 +536,12 @@ def scoreParcel(county,imgName,minAcres,maxAcres):
     # plt.show()
     # print('\n\n\nimg shape',totalScore.shape,'dividers shape',dividers.shape)
 
-    return totalScore,dividers
+    # Cached in compact form; the cached copy is returned so a first run and later runs see the same arrays.
+    # An entry evicted as soon as it is saved, being over the size bound alone or by another process, isn't reloaded.
+    if cacheDir:
+        scorecache.saveScores(cacheDir,key,totalScore,dividers,valid)
+        cached = scorecache.loadScores(cacheDir,key)
+        if cached is not None:
+            return cached
+
+    return totalScore,dividers,valid
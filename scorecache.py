@@ -0,0 +1,91 @@
+# Module for the on-disk cache of scored parcels.
+# Each entry holds a parcel's totalScore, dividers and valid mask from score.scoreParcel as memory-mappable .npy files.
+# Entries are keyed by the parcel name, its input files' path, size and modification time, and by the scoring weights.
+import os
+import json
+import hashlib
+import numpy as np
+
+# Bump when the scoring functions change, so older entries are no longer used.
+scoreVersion = 4
+
+# File suffixes of an entry's totalScore, dividers and valid arrays.
+entryFiles = ['_score.npy','_dividers.npy','_valid.npy']
+
+# Default size bound of a cache directory.
+cacheBytes = 20*1024**3
+
+# Share of the size bound a process writes between evictions.
+# Listing a large cache directory costs more than scoring a small parcel, so it isn't done on every save.
+evictShare = 1/64
+
+# Bytes written by this process to each cache directory since it last evicted there.
+written = {}
+
+# Return the cache key of a parcel from its name, its input files and the scoring weights.
+# The name tells apart parcels read from the same files, as in the county store.
+def cacheKey(name,paths,weights):
+    ident = [scoreVersion,name,sorted(weights.items())]
+    for p in paths:
+        st = os.stat(p)
+        ident.append([os.path.abspath(p),st.st_size,st.st_mtime_ns])
+    return hashlib.sha1(json.dumps(ident).encode()).hexdigest()
+
+# Return the cached totalScore, dividers and valid as read-only memory maps, or None if not cached.
+def loadScores(cacheDir,key):
+    paths = [os.path.join(cacheDir,key+name) for name in entryFiles]
+    try:
+        arrays = tuple(np.load(path,mmap_mode='r') for path in paths)
+    except (OSError,ValueError):
+        return None
+
+    # Access time is kept up to date for eviction.
+    try:
+        for path in paths:
+            os.utime(path)
+    except OSError:
+        pass
+    return arrays
+
+# Write a parcel's totalScore as float32 with boolean dividers and valid.
+# Files are written under a temporary name first, and the score last, so a reader never sees a partial entry.
+# Old entries over maxBytes are evicted each time this process has written evictShare of it,
+# so the cache exceeds its bound by at most that share per process.
+def saveScores(cacheDir,key,totalScore,dividers,valid,maxBytes=cacheBytes):
+    os.makedirs(cacheDir,exist_ok=True)
+    # Arrays already of the stored dtype, e.g. windowed scratch arrays, are written without a copy.
+    for name,arr in (('_dividers.npy',np.asarray(dividers,dtype=bool)),('_valid.npy',np.asarray(valid,dtype=bool)),
+                     ('_score.npy',np.asarray(totalScore,dtype=np.float32))):
+        path = os.path.join(cacheDir,key+name)
+        tmpPath = '{}.{}.tmp'.format(path,os.getpid())
+        with open(tmpPath,'wb') as f:
+            np.save(f,arr)
+        os.replace(tmpPath,path)
+        written[cacheDir] = written.get(cacheDir,0)+arr.nbytes
+    if written[cacheDir] >= maxBytes*evictShare:
+        evict(cacheDir,maxBytes)
+        written[cacheDir] = 0
+
+# Remove the least recently used entries until the cache directory is within maxBytes.
+def evict(cacheDir,maxBytes):
+    entries = {}
+    for file in os.listdir(cacheDir):
+        if file.endswith('.npy'):
+            try:
+                st = os.stat(os.path.join(cacheDir,file))
+            except OSError:
+                continue
+            key = file.rsplit('_',1)[0]
+            size,used = entries.get(key,(0,0))
+            entries[key] = (size+st.st_size,max(used,st.st_mtime))
+    total = sum(size for size,used in entries.values())
+    for key,(size,used) in sorted(entries.items(),key=lambda item:item[1][1]):
+        if total <= maxBytes:
+            break
+        try:
+            for name in entryFiles:
+                os.remove(os.path.join(cacheDir,key+name))
+        except OSError:
+            # Entry is open in another worker, e.g. on Windows; left for a later eviction.
+            continue
+        total -= size
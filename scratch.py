@@ -0,0 +1,43 @@
+# Module for the memory-mapped scratch arrays of windowed parcel processing.
+# While a parcel is windowed, its large arrays are memory maps in a scratch directory rather than in memory,
+# and are filled a block of rows at a time, so a parcel of any size runs within a bounded memory footprint.
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# Scratch directory of the current parcel, None while the parcel is processed in memory.
+state = {'dir':None}
+
+# Pixels per block of rows for windowed reads and writes.
+blockPixels = 1<<20
+
+# Start windowed processing of a parcel in a new scratch directory under root.
+def startScratch(root=None):
+    if root is not None:
+        os.makedirs(root,exist_ok=True)
+    state['dir'] = tempfile.mkdtemp(prefix='scratch',dir=root)
+    return state['dir']
+
+# End windowed processing, removing the scratch directory.
+# Files still mapped, e.g. on Windows, are left behind in it.
+def clearScratch():
+    if state['dir'] is not None:
+        shutil.rmtree(state['dir'],ignore_errors=True)
+        state['dir'] = None
+
+# Return True while the current parcel is windowed.
+def windowed():
+    return state['dir'] is not None
+
+# Return an empty array, memory-mapped in the scratch directory while windowed.
+# The backing file is a temporary file, so its disk space is freed with the array.
+def scratchArray(shape,dtype):
+    if state['dir'] is None or np.prod(shape) == 0:
+        return np.empty(shape,dtype=dtype)
+    return np.memmap(tempfile.TemporaryFile(dir=state['dir']),dtype=dtype,mode='w+',shape=tuple(shape))
+
+# Return row slices covering shape, each of about pixels pixels.
+def blocks(shape,pixels=blockPixels):
+    step = max(1,pixels//max(1,shape[1]))
+    return [slice(r0,min(r0+step,shape[0])) for r0 in range(0,shape[0],step)]
@@ -1,25 +1,40 @@
 #Functional module for searching for best AOI in parcel
 import numpy as np
 import tifffile as tiff
-from scipy.ndimage import rotate
 import scipy
 from scipy import ndimage
+from scipy.spatial import ConvexHull
 import time
 import cv2
 import matplotlib.pyplot as plt
 from operator import itemgetter
+from rotation import rotateStack, rotationTransform
+from scratch import scratchArray, blocks
+import heapq
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # Check if target has enough positive area to fit an AOI.
-def sizeCheck(minAcres,maxAcres,img):
+# The parcel's area is taken from the valid mask if given, else from the pixels that aren't -1.
+# Given a parcel mask, only positive pixels inside it count towards the AOI area.
+def sizeCheck(minAcres,maxAcres,img,valid=None,mask=None):
 
     # Convert acres to meters-squared.
     convFactor = 0.000247105381467165
     minM = round(minAcres/convFactor)
     maxM = round(maxAcres/convFactor)
 
-    # Return the area of positive cells from scored parcel.
-    totalArea = (np.sum(img!=-1))
-    areaCount = (np.sum(img>0))
+    # Return the area of positive cells from scored parcel, counted a block of rows at a time.
+    totalArea = 0
+    areaCount = 0
+    for rows in blocks(img.shape):
+        if valid is not None:
+            totalArea += np.count_nonzero(valid[rows])
+        else:
+            totalArea += np.count_nonzero(img[rows]!=-1)
+        if mask is not None:
+            areaCount += np.count_nonzero((img[rows]>0)&mask[rows])
+        else:
+            areaCount += np.count_nonzero(img[rows]>0)
     if areaCount >= maxM:
         useable = True
 
@@ -33,34 +48,142 @@ def sizeCheck(minAcres,maxAcres,img):
         useable = False
     return useable,minM,maxM
 
+# Corner points of the positive pixels, taken at the ends of each row.
+# The convex hull of these points is the convex hull of the whole footprint.
+def footprintPoints(img):
+    rows,first,last = [],[],[]
+    for block in blocks(img.shape):
+        footprint = img[block]>0
+        blockRows = np.flatnonzero(footprint.any(axis=1))
+        rows.append(blockRows+block.start)
+        first.append(np.argmax(footprint[blockRows],axis=1))
+        last.append(footprint.shape[1]-1-np.argmax(footprint[blockRows,::-1],axis=1))
+    rows,first,last = np.concatenate(rows),np.concatenate(first),np.concatenate(last)
+    x = np.concatenate([first-0.5,first-0.5,last+0.5,last+0.5])
+    y = np.concatenate([rows-0.5,rows+0.5,rows-0.5,rows+0.5])
+    return np.stack([x,y],axis=1)
+
+# Bounding box area of points after rotating by each angle (degrees), as scipy.ndimage.rotate would.
+def boxAreas(points,angles):
+    t = np.deg2rad(np.asarray(angles,dtype=float))[:,np.newaxis]
+    u = points[:,0]*np.cos(t)+points[:,1]*np.sin(t)
+    v = -points[:,0]*np.sin(t)+points[:,1]*np.cos(t)
+    return (u.max(axis=1)-u.min(axis=1))*(v.max(axis=1)-v.min(axis=1))
+
 # Input score parcel, return the primary rotation of the parcel.
-def rotationCheck(img):
-    shapes = {}
-    for r in range(0,90,5):
-        rotated = rotate(img,r,reshape=True, mode='constant', cval=-1)
-        rotated[rotated<0]=0
-        rotated = rotated[~np.all(rotated==0, axis=1)]
-        rotated = rotated[:,~np.all(rotated==0, axis=0)]
-        size = rotated.shape[0]*rotated.shape[1]
-        shapes.update({r:size})
-    return min(shapes, key=shapes.get)
+# The rotation with the smallest bounding box is found from the convex hull of the positive footprint.
+# With step (degrees), only multiples of step in 0-90 are tested, as the previous 5 degree search did.
+# With step=None, the exact minimum-area rectangle angle from the hull edges is returned.
+def rotationCheck(img,step=5):
+    points = footprintPoints(img)
+    if len(points)==0:
+        return 0
+    points = points[ConvexHull(points).vertices]
+    if step is not None:
+        angles = np.arange(0,90,step)
+    else:
+        # The minimum-area rectangle has a side on one of the hull edges.
+        edges = np.roll(points,-1,axis=0)-points
+        angles = np.unique(np.round(np.degrees(np.arctan2(edges[:,1],edges[:,0]))%90,6))
+        angles[angles>=90] = 0
+    areas = boxAreas(points,angles)
+    return angles[np.argmin(areas)].item()
 
 # Input scored parcel and degree, return rotated scored image.
-def rotateImg(rotation,img,dividers):
+# Interpolation is one of rotation.interpolations ('nearest', 'bilinear', or the previous 'cubic').
+def rotateImg(rotation,img,dividers,interpolation='bilinear'):
 
     # All reshaped boundaries are given value of -1.
-    rotated = rotate(img,rotation,reshape=True, mode='constant', cval=-1)
-
-    # Also rotate dividers to same primary rotation value.
-    rotatedDiv = rotate(dividers,rotation,reshape=True)
+    # Also rotate dividers to same primary rotation value, in the same warp.
+    rotated,rotatedDiv = rotateStack(img,dividers,rotation,interpolation)
     rowsEnd = rotated.shape[0]
     columnsEnd = rotated.shape[1]
     columnsStart = 0  # Starting place for Top Left x
     rowsStart = 0  # Starting place for Top Left y
     return rotated,columnsStart,columnsEnd,rowsStart,rowsEnd,rotatedDiv
 
+# Summed-area table with a zero row and column prepended, so any rectangle sum is four lookups.
+# Built a block of rows at a time from values(rows), the values of those rows of a raster of shape.
+def integralImage(shape,dtype,values):
+    table = scratchArray((shape[0]+1,shape[1]+1),dtype)
+    table[0] = 0
+    table[:,0] = 0
+    for rows in blocks(shape):
+        out = table[rows.start+1:rows.stop+1,1:]
+        np.cumsum(np.cumsum(values(rows),axis=0,dtype=dtype),axis=1,out=out)
+        out += table[rows.start,1:]
+    return table
+
+# Sum of the original array within rows TLr:BRr and columns TLc:BRc.
+def rectSum(table,TLr,BRr,TLc,BRc):
+    return table[BRr,BRc]-table[TLr,BRc]-table[BRr,TLc]+table[TLr,TLc]
+
+# Build the lookup tables for one rotated parcel.
+# Positive pixel counts and positive score sums use summed-area tables.
+# Running counts of positive pixels along rows and columns are used to find all non-positive edges.
+def buildTables(img):
+    return summedTables(img.shape,lambda rows:img[rows]>0,lambda rows:np.where(img[rows]>0,img[rows],0))
+
+# Build the lookup tables of a grid of shape, a block of rows at a time.
+# pos(rows) and sums(rows) give the positive flags and positive score sums of those rows of the grid.
+# counts(rows) gives their positive pixel counts, by default the positive flags.
+def summedTables(shape,pos,sums,counts=None):
+    if counts is None:
+        counts = pos
+    rowPos = scratchArray((shape[0],shape[1]+1),np.int32)
+    colPos = scratchArray((shape[0]+1,shape[1]),np.int32)
+    rowPos[:,0] = 0
+    colPos[0] = 0
+    for rows in blocks(shape):
+        blockPos = pos(rows)
+        np.cumsum(blockPos,axis=1,out=rowPos[rows,1:])
+        out = colPos[rows.start+1:rows.stop+1]
+        np.cumsum(blockPos,axis=0,out=out)
+        out += colPos[rows.start]
+    tables = {
+              'count':integralImage(shape,np.int32,counts),
+              'sum':integralImage(shape,np.float64,sums),
+              'rowPos':rowPos,
+              'colPos':colPos,
+              'emptyRows':{},
+              'emptyCols':{}
+              }
+    return tables
+
+# Running count of rows holding no positive pixels between columns TLc:BRc.
+# Cached per column span, so every later row span is a single lookup.
+def emptyRowCounts(tables,TLc,BRc):
+    cum = tables['emptyRows'].get((TLc,BRc))
+    if cum is None:
+        empty = (tables['rowPos'][:,BRc]-tables['rowPos'][:,TLc])==0
+        cum = np.zeros(empty.shape[0]+1,dtype=np.int32)
+        np.cumsum(empty,out=cum[1:])
+        tables['emptyRows'][(TLc,BRc)] = cum
+    return cum
+
+# Running count of columns holding no positive pixels between rows TLr:BRr.
+def emptyColCounts(tables,TLr,BRr):
+    cum = tables['emptyCols'].get((TLr,BRr))
+    if cum is None:
+        empty = (tables['colPos'][BRr,:]-tables['colPos'][TLr,:])==0
+        cum = np.zeros(empty.shape[0]+1,dtype=np.int32)
+        np.cumsum(empty,out=cum[1:])
+        tables['emptyCols'][(TLr,BRr)] = cum
+    return cum
+
+# Number of rows within TLr:BRr holding no positive pixels between columns TLc:BRc.
+def emptyRows(tables,TLr,BRr,TLc,BRc):
+    cum = emptyRowCounts(tables,TLc,BRc)
+    return cum[BRr]-cum[TLr]
+
+# Number of columns within TLc:BRc holding no positive pixels between rows TLr:BRr.
+def emptyCols(tables,TLr,BRr,TLc,BRc):
+    cum = emptyColCounts(tables,TLr,BRr)
+    return cum[BRc]-cum[TLc]
+
 # Determine if rectangle contains enough usable area. Used to filter sites before processing.
-def calculateSize(height,width,TLr,BRr,TLc,BRc,minM,maxM,img):
+# With lookup tables from buildTables, no pixels of the rectangle are touched.
+def calculateSize(height,width,TLr,BRr,TLc,BRc,minM,maxM,img,tables=None):
 
     # Shape is checked to prevent over-long AOIs.
     area = (height*width)
@@ -68,11 +191,17 @@ def calculateSize(height,width,TLr,BRr,TLc,BRc,minM,maxM,img):
 
         # Only positive pixels are counted as viable area.
         newMatrix = img[TLr:BRr,TLc:BRc]
-        tempMatrix = newMatrix[~np.all(newMatrix<=0, axis=1)]
-        tempMatrix = tempMatrix[:,~np.all(tempMatrix<=0, axis=0)]
-        if tempMatrix.shape!=newMatrix.shape:
-            return False
-        useableArea = np.sum(newMatrix>0)
+        if tables is not None:
+            # Any all non-positive row or column would be trimmed, so the rectangle is rejected.
+            if emptyRows(tables,TLr,BRr,TLc,BRc)>0 or emptyCols(tables,TLr,BRr,TLc,BRc)>0:
+                return False
+            useableArea = rectSum(tables['count'],TLr,BRr,TLc,BRc)
+        else:
+            tempMatrix = newMatrix[~np.all(newMatrix<=0, axis=1)]
+            tempMatrix = tempMatrix[:,~np.all(tempMatrix<=0, axis=0)]
+            if tempMatrix.shape!=newMatrix.shape:
+                return False
+            useableArea = np.sum(newMatrix>0)
         if useableArea>=minM and useableArea<=maxM:
             return newMatrix
         else:
@@ -80,18 +209,22 @@ def calculateSize(height,width,TLr,BRr,TLc,BRc,minM,maxM,img):
     else:
         return False
 
+# Boolean mask of contiguous pixels; out-of-bounds (0) and dividers (-1 or lower) are excluded.
+# Boolean dividers, as scoreParcel and rotateStack return, are already this mask.
+def dividerMask(dividers):
+    if dividers.dtype == bool:
+        return dividers
+    return (dividers>-1)&(dividers!=0)
+
 # Create an array with dividing factors(roads,water,rails,etc).
 def createDivider(dividers,TLr,BRr,TLc,BRc):
 
     # Extract matrix from same coordinates as searching rectangle returned from iterateCorners.
-    contMatrix = dividers[TLr:BRr,TLc:BRc]
-    contMatrix[contMatrix==0]=-1
-    contMatrix[contMatrix<-1]=-1
-    contMatrix = (contMatrix!=-1).astype(float)
+    # The dividers raster itself is left unchanged.
+    contMatrix = dividerMask(dividers[TLr:BRr,TLc:BRc])
     # kernel = np.ones((3,3),np.uint8)/9
     # for i in range(5):
-    #     contMatrix = cv2.filter2D(contMatrix,-1,kernel)
-    contMatrix[contMatrix>0]=1
+    #     contMatrix = cv2.filter2D(contMatrix.astype(float),-1,kernel)>0
     return contMatrix
 
 # Determine the number and size of usable blobs in a viable searching rectangle.
@@ -101,27 +234,71 @@ def calculateBlobs(contMatrix,minM,maxM):
     # Create separated blobs.
     blobs,numBlobs = ndimage.label(contMatrix)
 
-    # Create empy dict to record blob sizes.
-    blobAreas = {}
-
-    for n in range(numBlobs+1):
-        blobArea = np.sum(blobs==n)
-        blobAreas[n]=blobArea
-
-    # If multiple blobs exist, the blob representing out-of-bounds or dividers pixels is removed.
-    if len(blobAreas)>1:
-        del blobAreas[0]
+    # Record blob sizes.
+    blobAreas = np.bincount(blobs.ravel(),minlength=numBlobs+1)
 
+    # The blob representing out-of-bounds or dividers pixels is never taken.
+    # Without any blob the mask is empty, so the rectangle scores 0.
     # The blob with the highest score is checked against the AOI size parameters.
-    bestBlob = max(blobAreas,key=blobAreas.get)
+    if numBlobs==0:
+        return np.zeros(contMatrix.shape,dtype=bool)
+    bestBlob = np.argmax(blobAreas[1:])+1
     if blobAreas[bestBlob]>=minM and blobAreas[bestBlob]<=maxM:
         # print(blobAreas,bestBlob)
-        blobs[blobs!=bestBlob]=0
-        blobs[blobs!=0]=1
-        return blobs
+        return blobs==bestBlob
     else:
         return False
 
+# Label the contiguous blobs of a whole rotated dividers raster once.
+# Returns the labels and the full area of every blob, used by windowBlobs for each searching rectangle.
+def buildBlobs(dividers):
+    labels = scratchArray(dividers.shape,np.int32)
+    numBlobs = ndimage.label(dividerMask(dividers),output=labels)
+    areas = np.zeros(numBlobs+1,dtype=np.int64)
+    for rows in blocks(labels.shape):
+        areas += np.bincount(labels[rows].ravel(),minlength=numBlobs+1)
+    blobIndex = {
+                 'labels':labels,
+                 'areas':areas
+                 }
+    return blobIndex
+
+# Same result as calculateBlobs(createDivider(...)), using the labels of buildBlobs.
+# Blobs lying wholly inside the rectangle keep their label and area.
+# Only blobs cut by the rectangle edge are labelled again, and only if one could be the largest.
+# Of blobs of equal area, the first in scan order of the rectangle is taken, as calculateBlobs does.
+def windowBlobs(blobIndex,TLr,BRr,TLc,BRc,minM,maxM):
+    window = blobIndex['labels'][TLr:BRr,TLc:BRc]
+    counts = np.bincount(window.ravel(),minlength=len(blobIndex['areas']))
+    counts[0] = 0
+    whole = counts==blobIndex['areas']
+    whole[0] = False
+    bestArea = counts[whole].max(initial=0)
+
+    # Whole blobs are labelled in scan order, so the lowest label of the largest is the first.
+    best = None
+    if bestArea>0:
+        best = window==np.flatnonzero(whole&(counts==bestArea))[0]
+
+    # Parts of cut blobs are at most their count within the rectangle.
+    cut = (counts>=max(bestArea,1))&~whole
+    if cut.any():
+        pieces,numPieces = ndimage.label(cut[window])
+        pieceAreas = np.bincount(pieces.ravel(),minlength=numPieces+1)
+        pieceAreas[0] = 0
+        if pieceAreas.max()>=bestArea:
+            piece = pieces==np.argmax(pieceAreas)
+            if pieceAreas.max()>bestArea or np.argmax(piece)<np.argmax(best):
+                best = piece
+            bestArea = pieceAreas.max()
+
+    # Without any blob the mask is empty, as calculateBlobs gives.
+    if best is None:
+        return np.zeros(window.shape,dtype=bool)
+    if bestArea>=minM and bestArea<=maxM:
+        return best
+    return False
+
 # Checks how rectangular and whole the aoi is.
 def rectCheck(checkMatrix):
     tempMatrix = checkMatrix[~np.all(checkMatrix<=0, axis=1)]
@@ -129,18 +306,23 @@ def rectCheck(checkMatrix):
     if tempMatrix.shape!=checkMatrix.shape:
         return np.zeros((1,1))
     ratio = np.sum(checkMatrix>0)/(checkMatrix.shape[0]*checkMatrix.shape[1])
-    threshold = 0.30
-    if ratio>=threshold:
-        factor = ((ratio-threshold)/(1.0-threshold))*(1.0-0.8)+0.8
+    factor = rectFactor(ratio)
+    if factor>0:
         tempMatrix[tempMatrix>0]*=factor
         return tempMatrix
     else:
         return np.zeros((1,1))
 
+# Scaling factor of rectCheck for the share of positive pixels in the AOI, 0 below the threshold.
+def rectFactor(ratio):
+    threshold = 0.30
+    if ratio>=threshold:
+        return ((ratio-threshold)/(1.0-threshold))*(1.0-0.8)+0.8
+    return 0
+
 # Check the sum of the largest blob, compare against the previous best sums.
 def checkSum(blobs,newMatrix,minM,maxM,placeSum,placeMatrix):
-    checkMatrix = np.ma.masked_where(blobs!=1,newMatrix)
-    checkMatrix = checkMatrix.filled(0)
+    checkMatrix = np.where(blobs==1,newMatrix,0).astype(newMatrix.dtype,copy=False)
     useableArea = np.sum(checkMatrix>1)
 
     checkMatrix[checkMatrix<=0]=0
@@ -156,50 +338,513 @@ def checkSum(blobs,newMatrix,minM,maxM,placeSum,placeMatrix):
     else:
         return placeSum,placeMatrix,False
 
+# Upper bound on the checkSum result of any blob within rows TLr:BRr and columns TLc:BRc.
+# A blob holds at most the positive scores of its rectangle, and rectCheck scales them by at most 1.0.
+def rectBound(tables,TLr,BRr,TLc,BRc):
+    return rectSum(tables['sum'],TLr,BRr,TLc,BRc)*1.0
+
 # Iterate through all possible TopLeft (TL) and BottomRight (BR) corners.
-def iterateCorners(rowsStart,columnsStart,rowsEnd,columnsEnd,minM,maxM,dividers,rotation,img):
-    placeSum = 0
-    placeMatrix = 0
-    for TLr in range(rowsStart,rowsEnd-30,70):
-        for TLc in range(columnsStart,columnsEnd-10,70):
+# Yields the corners of every searching rectangle that passes calculateSize.
+# If best holds the current best sum, TL corners whose remaining area can't beat it are skipped.
+def scanCandidates(rowsStart,columnsStart,rowsEnd,columnsEnd,minM,maxM,img,tables,stride=70,minHeight=30,minWidth=10,
+                   best=None):
+    for TLr in range(rowsStart,rowsEnd-minHeight,stride):
+
+        # The area below a TL row only shrinks, so no later row can beat the best sum either.
+        if best is not None and rectBound(tables,TLr,rowsEnd,columnsStart,columnsEnd)<=best[0]:
+            break
+        for TLc in range(columnsStart,columnsEnd-minWidth,stride):
+            if best is not None and rectBound(tables,TLr,rowsEnd,TLc,columnsEnd)<=best[0]:
+                break
 
             # Mandatory 30m height and 10m width to allow for minimum unit size.
             # If search area is not of viable size, blobs are not created and score is not recorded.
-            for BRr in range(TLr+30,rowsEnd,70):
-                for BRc in range(TLc+10,columnsEnd,70):
+            for BRr in range(TLr+minHeight,rowsEnd,stride):
+                for BRc in range(TLc+minWidth,columnsEnd,stride):
                     height=BRr-TLr
                     width=BRc-TLc
-                    if height>=30 and width>=10:
-                        newMatrix = calculateSize(height,width,TLr,BRr,TLc,BRc,minM,maxM,img)
+                    if height>=minHeight and width>=minWidth:
+                        newMatrix = calculateSize(height,width,TLr,BRr,TLc,BRc,minM,maxM,img,tables)
+                        if isinstance(newMatrix,np.ndarray):
+                            yield TLr,TLc,BRr,BRc
+
+# Yield the candidates of batchCandidates, already in scanCandidates order, pruned as scanCandidates prunes them.
+# Lets the scalar search reuse the candidates parcelSearch prepared for its rotation bounds.
+def scanPrepared(candidates,tables,columnsStart,rowsEnd,columnsEnd,best):
+    skipRow = None
+    for TLr,TLc,BRr,BRc in candidates.tolist():
+        if TLr == skipRow:
+            continue
+        if rectBound(tables,TLr,rowsEnd,columnsStart,columnsEnd)<=best[0]:
+            return
+        if rectBound(tables,TLr,rowsEnd,TLc,columnsEnd)<=best[0]:
+            skipRow = TLr
+            continue
+        yield TLr,TLc,BRr,BRc
+
+# Return all TL or BR corner pairs along one axis, with the mandatory minimum length.
+def cornerPairs(start,end,minLength,stride):
+    TL = np.arange(start,end-minLength,stride)
+    BR = TL[:,np.newaxis]+minLength+np.arange(0,max(end-start-minLength,0),stride)
+    TL = np.broadcast_to(TL[:,np.newaxis],BR.shape)
+    valid = BR<end
+    return TL[valid],BR[valid]
+
+# Apply the calculateSize filters to arrays of corners, return the corners that pass.
+def filterCandidates(TLr,TLc,BRr,BRc,minM,maxM,tables,minHeight=30,minWidth=10):
+    height = BRr-TLr
+    width = BRc-TLc
+
+    # Shape is checked to prevent over-long AOIs.
+    area = height*width
+    keep = (height>=minHeight)&(width>=minWidth)&(area>=minM)&(area<=1.0*maxM)
+    keep[keep] = (width[keep]/height[keep]>0.2)&(height[keep]/width[keep]>=0.2)
+    TLr,TLc,BRr,BRc = TLr[keep],TLc[keep],BRr[keep],BRc[keep]
+
+    # Only positive pixels are counted as viable area.
+    count = tables['count']
+    useableArea = count[BRr,BRc]-count[TLr,BRc]-count[BRr,TLc]+count[TLr,TLc]
+    keep = (useableArea>=minM)&(useableArea<=maxM)
+    TLr,TLc,BRr,BRc = TLr[keep],TLc[keep],BRr[keep],BRc[keep]
+    if len(TLr)==0:
+        return TLr,TLc,BRr,BRc
+
+    # Any all non-positive row or column would be trimmed, so the rectangle is rejected.
+    spans,inv = np.unique(np.stack([TLc,BRc],axis=1),axis=0,return_inverse=True)
+    inv = inv.ravel()
+    cums = np.stack([emptyRowCounts(tables,s[0],s[1]) for s in spans.tolist()])
+    keep = (cums[inv,BRr]-cums[inv,TLr])==0
+    spans,inv = np.unique(np.stack([TLr,BRr],axis=1),axis=0,return_inverse=True)
+    inv = inv.ravel()
+    cums = np.stack([emptyColCounts(tables,s[0],s[1]) for s in spans.tolist()])
+    keep &= (cums[inv,BRc]-cums[inv,TLc])==0
+    return TLr[keep],TLc[keep],BRr[keep],BRc[keep]
+
+# Build every searching rectangle of a rotation as arrays and apply the calculateSize filters to the whole batch.
+# Survivors are returned in the same order as scanCandidates yields them.
+def batchCandidates(rowsStart,columnsStart,rowsEnd,columnsEnd,minM,maxM,tables,stride=70,minHeight=30,minWidth=10,
+                    batchSize=1000000):
+    rowTL,rowBR = cornerPairs(rowsStart,rowsEnd,minHeight,stride)
+    colTL,colBR = cornerPairs(columnsStart,columnsEnd,minWidth,stride)
+    if len(rowTL)==0 or len(colTL)==0:
+        return np.zeros((0,4),dtype=np.int64)
+    survivors = []
+
+    # Row pairs are taken in blocks so the candidate arrays stay within batchSize.
+    block = max(1,batchSize//len(colTL))
+    for b in range(0,len(rowTL),block):
+        r,c = np.divmod(np.arange(min(block,len(rowTL)-b)*len(colTL)),len(colTL))
+        TLr,TLc,BRr,BRc = filterCandidates(rowTL[b+r],colTL[c],rowBR[b+r],colBR[c],minM,maxM,tables,minHeight,minWidth)
+        survivors.append(np.stack([TLr,TLc,BRr,BRc],axis=1))
+
+    survivors = np.concatenate(survivors)
+    order = np.lexsort((survivors[:,3],survivors[:,2],survivors[:,1],survivors[:,0]))
+    return survivors[order]
 
-                        # Positive pixels in search area divided into contiguous blobs for individual scoring.
-                        if type(newMatrix)==np.ndarray:
-                            contMatrix = createDivider(dividers,TLr,BRr,TLc,BRc)
-                            blobs = calculateBlobs(contMatrix,minM,maxM)
+# Scale the positive scores of img by factor, a block of rows at a time.
+def scalePositive(img,factor):
+    scaled = scratchArray(img.shape,img.dtype)
+    for rows in blocks(img.shape):
+        block = img[rows]
+        scaled[rows] = np.where(block<=0,block,factor*block)
+    return scaled
 
-                            # Individual blob score recorded.
-                            if type(blobs)==np.ndarray:
-                                # print('Valid for checking')
-                                placeSum,placeMatrix,check = checkSum(blobs,newMatrix,minM,maxM,placeSum,placeMatrix)
+# Score the best blob of one searching rectangle.
+# Blobs are taken from blobIndex if given, else labelled from the dividers.
+# Returns the sum and the scored AOI matrix, or 0 and 0 if no usable blob exists.
+def scoreRectangle(img,dividers,TLr,TLc,BRr,BRc,minM,maxM,blobIndex=None):
+    newMatrix = img[TLr:BRr,TLc:BRc]
+
+    # Positive pixels in search area divided into contiguous blobs for individual scoring.
+    if blobIndex is not None:
+        blobs = windowBlobs(blobIndex,TLr,BRr,TLc,BRc,minM,maxM)
+    else:
+        contMatrix = createDivider(dividers,TLr,BRr,TLc,BRc)
+        blobs = calculateBlobs(contMatrix,minM,maxM)
+
+    # Individual blob score recorded.
+    if isinstance(blobs,np.ndarray):
+        tempSum,checkMatrix,check = checkSum(blobs,newMatrix,minM,maxM,0,0)
+        return tempSum,checkMatrix
+    return 0,0
+
+# Score the blobs of every candidate rectangle, keeping the best.
+# Candidates come from scanCandidates, or from batchCandidates if batch is True.
+# Candidates already filtered by batchCandidates, e.g. by parcelSearch, may be given with their tables.
+# Rectangles whose upper bound can't beat bestSum or the best found so far are not labelled.
+# Returns the best sum, its corners, the rotation, and the scored AOI matrix.
+def iterateCorners(rowsStart,columnsStart,rowsEnd,columnsEnd,minM,maxM,dividers,rotation,img,stride=70,batch=False,
+                   minHeight=30,minWidth=10,tables=None,bestSum=0,candidates=None):
+    placeSum = 0
+    placeMatrix = 0
+    placeCorners = (0,0,0,0)
+    best = [bestSum]
+
+    # Lookup tables and blob labels are built once per rotation and shared by every searching rectangle.
+    if tables is None:
+        tables = buildTables(img)
+    blobIndex = buildBlobs(dividers)
+    if batch:
+        if candidates is None:
+            candidates = batchCandidates(rowsStart,columnsStart,rowsEnd,columnsEnd,minM,maxM,tables,stride,
+                                         minHeight,minWidth)
+        return scoreCandidates(candidates,img,dividers,minM,maxM,rotation,tables,blobIndex,best)
+
+    if candidates is None:
+        corners = scanCandidates(rowsStart,columnsStart,rowsEnd,columnsEnd,minM,maxM,img,tables,stride,
+                                 minHeight,minWidth,best)
+    else:
+        corners = scanPrepared(candidates,tables,columnsStart,rowsEnd,columnsEnd,best)
+    for TLr,TLc,BRr,BRc in corners:
+        if rectBound(tables,TLr,BRr,TLc,BRc)<=best[0]:
+            continue
+        tempSum,checkMatrix = scoreRectangle(img,dividers,TLr,TLc,BRr,BRc,minM,maxM,blobIndex)
+        if tempSum > best[0]:
+            best[0] = tempSum
+            placeSum,placeMatrix = tempSum,checkMatrix
+            placeCorners = (TLc,TLr,BRc,BRr)
+    TLc,TLr,BRc,BRr = placeCorners
+    return [placeSum,TLc,TLr,BRc,BRr,rotation,placeMatrix]
+
+# Score an array of candidate rectangles from the highest upper bound down, keeping the best.
+# The search stops at the first bound that can't beat best, which holds the best sum found so far.
+# best may be shared by the threads of parallelSearch; it only ever holds sums that were found,
+# so a stale value prunes less but never wrongly.
+def scoreCandidates(candidates,img,dividers,minM,maxM,rotation,tables,blobIndex,best):
+    placeSum = 0
+    placeMatrix = 0
+    placeCorners = (0,0,0,0)
+    bounds = rectBound(tables,candidates[:,0],candidates[:,2],candidates[:,1],candidates[:,3])
+    order = np.argsort(-bounds,kind='stable')
+    for bound,(TLr,TLc,BRr,BRc) in zip(bounds[order].tolist(),candidates[order].tolist()):
+        if bound<=best[0]:
+            break
+        tempSum,checkMatrix = scoreRectangle(img,dividers,TLr,TLc,BRr,BRc,minM,maxM,blobIndex)
+        if tempSum > best[0] and tempSum > placeSum:
+            best[0] = max(best[0],tempSum)
+            placeSum,placeMatrix = tempSum,checkMatrix
+            placeCorners = (TLc,TLr,BRc,BRr)
+    TLc,TLr,BRc,BRr = placeCorners
+    return [placeSum,TLc,TLr,BRc,BRr,rotation,placeMatrix]
+
+# Search the prepared rotations of parcelSearch on a pool of workers, merged by parcelSearch on the best sum.
+# With threads, each rotation is split into interleaved TL-row bands, all sharing one best sum,
+# and searched with the tables, candidates and blob labels parcelSearch prepared for it.
+# With processes, each rotation is one task. Inside combfunc's pool only threads can be used,
+# as pool workers can't start processes of their own.
+def parallelSearch(prepared,minM,maxM,stride,workers,processes=False):
+    if processes:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(iterateCorners,0,0,rotated.shape[0],rotated.shape[1],minM,maxM,rotatedDiv,r,
+                                       rotated,stride,True) for bound,r,rotated,rotatedDiv,tables,candidates,blobIndex
+                       in prepared]
+            return [f.result() for f in futures]
+
+    best = [0]
+    with ThreadPoolExecutor(workers) as executor:
+        futures = []
+        for bound,r,rotated,rotatedDiv,tables,candidates,blobIndex in prepared:
+            rows = np.unique(candidates[:,0])
+            for band in range(workers):
+                inBand = np.isin(candidates[:,0],rows[band::workers])
+                futures.append(executor.submit(scoreCandidates,candidates[inBand],rotated,rotatedDiv,minM,maxM,r,
+                                               tables,blobIndex,best))
+        return [f.result() for f in futures]
+
+# Rotate a parcel by r and prepare its search, returning the rotation's upper bound, rotated rasters,
+# lookup tables and candidates, and its blob labels if blobs is True.
+# The upper bound is the best bound among the candidate rectangles.
+# The primary rotation startRot gets a 1.07 weighting.
+def prepareRotation(img,dividers,r,startRot,minM,maxM,stride,interpolation,blobs=False):
+    img01 = img
+    if r == startRot:
+        img01 = scalePositive(img01,1.07)
+    rotated,columnsStart,columnsEnd,rowsStart,rowsEnd,rotatedDiv =(rotateImg(r,img01,dividers,interpolation))
+    tables = buildTables(rotated)
+    candidates = batchCandidates(rowsStart,columnsStart,rowsEnd,columnsEnd,minM,maxM,tables,stride)
+    bound = rectBound(tables,candidates[:,0],candidates[:,2],candidates[:,1],candidates[:,3]).max(initial=0)
+    blobIndex = buildBlobs(rotatedDiv) if blobs else None
+    return [bound,r,rotated,rotatedDiv,tables,candidates,blobIndex]
+
+# Reduce a raster by blocks of factor x factor cells, padding the edges with fill.
+# Blocks are reduced by func, by default averaged as the scores are.
+def downsample(img,factor,fill,func=np.mean):
+    if factor == 1:
+        return img
+    rows = -(-img.shape[0]//factor)*factor
+    cols = -(-img.shape[1]//factor)*factor
+    padded = np.full((rows,cols),fill,dtype=img.dtype)
+    padded[:img.shape[0],:img.shape[1]] = img
+    return func(padded.reshape(rows//factor,factor,cols//factor,factor),axis=(1,3))
+
+# Contiguous mask without its divider specks, the divider areas of fewer than area pixels.
+# Diagonal neighbours count as touching, so thin divider lines at any angle are kept whole.
+def dropSpecks(contiguous,area):
+    specks,numSpecks = ndimage.label(~contiguous,structure=np.ones((3,3)))
+    small = np.bincount(specks.ravel(),minlength=numSpecks+1)<area
+    small[0] = False
+    return contiguous|small[specks]
+
+# Return the score and divider rasters for each pyramid level, keyed by level factor.
+# Dividers take the block minimum so no divider line is lost, after dropping the specks smaller than a block;
+# otherwise scattered divider pixels close off nearly every coarse cell.
+# Rectangles are checked against the full dividers again on the finest level.
+def buildPyramid(img,dividers,levels):
+    pyramid = {}
+    contiguous = dividerMask(dividers)
+    for f in levels:
+        if f > 1:
+            pyramid[f] = (downsample(img,f,-1),downsample(dropSpecks(contiguous,f*f),f,False,np.min))
+        else:
+            pyramid[f] = (img,contiguous)
+    return pyramid
+
+# Return the neighbourhood of a coarse result at a finer level.
+# Each corner is scaled by ratio and moved within radius cells, every step cells.
+def neighbourCandidates(result,ratio,radius,step,rowsEnd,columnsEnd):
+    TLc,TLr,BRc,BRr = [round(v*ratio) for v in result[1:5]]
+    offsets = np.arange(-radius,radius+1,step)
+    TLr,TLc,BRr,BRc = [a.ravel() for a in np.meshgrid(TLr+offsets,TLc+offsets,BRr+offsets,BRc+offsets,indexing='ij')]
+    TLr,BRr = np.clip(TLr,0,rowsEnd),np.clip(BRr,0,rowsEnd)
+    TLc,BRc = np.clip(TLc,0,columnsEnd),np.clip(BRc,0,columnsEnd)
+    return TLr,TLc,BRr,BRc
+
+# Score every candidate of one rotation, return the top results in the iterateCorners format.
+# Candidates are scored from the highest upper bound down, until no bound can enter the top results.
+def rankCandidates(candidates,img,dividers,minM,maxM,rotation,top,tables,blobIndex=None):
+    bounds = rectBound(tables,candidates[:,0],candidates[:,2],candidates[:,1],candidates[:,3])
+    order = np.argsort(-bounds,kind='stable')
+    results = []
+    for n,(TLr,TLc,BRr,BRc) in zip(order.tolist(),candidates[order].tolist()):
+        if len(results)==top and bounds[n]<=results[0][0]:
+            break
+        tempSum,checkMatrix = scoreRectangle(img,dividers,TLr,TLc,BRr,BRc,minM,maxM,blobIndex)
+        if tempSum > 0:
+            heapq.heappush(results,(tempSum,n,[tempSum,TLc,TLr,BRc,BRr,rotation,checkMatrix]))
+            if len(results)>top:
+                heapq.heappop(results)
+    return [r[2] for r in sorted(results,key=itemgetter(0),reverse=True)]
+
+# Coarse-to-fine search over the levels of buildPyramid, e.g. (8,4,1).
+# All rotations are searched on the coarsest level with stride meters.
+# At each finer level only the neighbourhoods of the top candidates are searched again.
+# Returns None if a level leaves no usable rectangle, so parcelSearch can search the full resolution instead.
+def pyramidSearch(img,dividers,minM,maxM,levels,stride=70,top=5,interpolation='bilinear'):
+    levels = sorted(set(levels)|{1},reverse=True)
+    pyramid = buildPyramid(img,dividers,levels)
+    coarse = levels[0]
+
+    startRot = rotationCheck(img)
+    rotations = [startRot,startRot+15,startRot+30,startRot+45,startRot+60,startRot+75]
+
+    # Rotated rasters, lookup tables and blob labels are built once per level and rotation.
+    rotatedLevels = {}
+    def rotatedLevel(f,r):
+        if (f,r) not in rotatedLevels:
+            img01,div01 = pyramid[f]
+            if r == startRot:
+                img01 = scalePositive(img01,1.07)
+            rotated,columnsStart,columnsEnd,rowsStart,rowsEnd,rotatedDiv = rotateImg(r,img01,div01,interpolation)
+            rotatedLevels[(f,r)] = (rotated,rotatedDiv,buildTables(rotated),buildBlobs(rotatedDiv))
+        return rotatedLevels[(f,r)]
+
+    # Full search of every rotation on the coarsest level.
+    step = max(1,round(stride/coarse))
+    results = []
+    for r in rotations:
+        rotated,rotatedDiv,tables,blobIndex = rotatedLevel(coarse,r)
+        candidates = batchCandidates(0,0,rotated.shape[0],rotated.shape[1],minM/coarse**2,maxM/coarse**2,tables,step,
+                                     max(1,round(30/coarse)),max(1,round(10/coarse)))
+        results += rankCandidates(candidates,rotated,rotatedDiv,minM/coarse**2,maxM/coarse**2,r,top,tables,blobIndex)
+    results = heapq.nlargest(top,results,key=itemgetter(0))
+    if len(results)==0:
+        return None
+    stepM = step*coarse
+
+    # Refine the neighbourhood of the top candidates on each finer level.
+    # Each level starts at half the previous level's step, in its own cells, and halves it down to one cell,
+    # so each corner is tried at three places per pass and the finest level places corners to the meter.
+    for prev,f in zip(levels[:-1],levels[1:]):
+        step = max(1,round(stepM/f/2))
+        ratio = prev/f
+        while True:
+            refined = []
+            for result in results:
+                rotated,rotatedDiv,tables,blobIndex = rotatedLevel(f,result[5])
+                TLr,TLc,BRr,BRc = neighbourCandidates(result,ratio,step,step,rotated.shape[0],rotated.shape[1])
+                TLr,TLc,BRr,BRc = filterCandidates(TLr,TLc,BRr,BRc,minM/f**2,maxM/f**2,tables,
+                                                   max(1,round(30/f)),max(1,round(10/f)))
+                candidates = np.unique(np.stack([TLr,TLc,BRr,BRc],axis=1),axis=0)
+                refined += rankCandidates(candidates,rotated,rotatedDiv,minM/f**2,maxM/f**2,result[5],top,tables,
+                                          blobIndex)
+            results = heapq.nlargest(top,refined,key=itemgetter(0))
+            if len(results)==0:
+                return None
+            ratio = 1
+            if step == 1:
+                break
+            step = max(1,step//2)
+        stepM = f
+        rotatedLevels = {k:v for k,v in rotatedLevels.items() if k[0]<=f}
+    return results[0]
+
+# Rotated frame cells of original pixels at rows,cols, for the frame of rotation.rotationTransform.
+# Each pixel falls in the nearest cell, as a nearest-neighbour warp would sample it.
+def frameCells(shape,angle,rows,cols):
+    transform,outShape = rotationTransform(shape,angle)
+    inverse = np.linalg.inv(transform[:,:2])
+    x = cols-transform[0,2]
+    y = rows-transform[1,2]
+    U = np.rint(inverse[1,0]*x+inverse[1,1]*y).astype(np.int64)
+    V = np.rint(inverse[0,0]*x+inverse[0,1]*y).astype(np.int64)
+    return np.clip(U,0,outShape[0]-1),np.clip(V,0,outShape[1]-1),outShape
+
+# Rotated frame cells of every original pixel for angle, as int32 rasters of rows (U) and columns (V).
+# Built a block of rows at a time, once per angle, so each searching rectangle only slices them.
+def frameGrid(shape,angle):
+    U = scratchArray(shape,np.int32)
+    V = scratchArray(shape,np.int32)
+    cols = np.arange(shape[1])
+    for rows in blocks(shape):
+        U[rows],V[rows],outShape = frameCells(shape,angle,np.arange(rows.start,rows.stop)[:,np.newaxis],cols)
+    return U,V
+
+# Build rotated lookup tables for one angle without resampling the parcel.
+# Positive pixels are binned into their rotated frame cells, so counts and sums are exact.
+# Returns the tables, the rotated shape and the frame cells of frameGrid.
+def buildFrameTables(img,angle):
+    transform,outShape = rotationTransform(img.shape,angle)
+    U,V = frameGrid(img.shape,angle)
+    positive = img>0
+    cells = U[positive].astype(np.int64)*outShape[1]+V[positive]
+    counts = np.bincount(cells,minlength=outShape[0]*outShape[1]).reshape(outShape)
+    sums = np.bincount(cells,weights=img[positive],minlength=outShape[0]*outShape[1]).reshape(outShape)
+    tables = summedTables(outShape,lambda rows:counts[rows]>0,lambda rows:sums[rows],lambda rows:counts[rows])
+    return tables,outShape,(U,V)
+
+# Score the best blob of a rotated searching rectangle directly in the original raster frame.
+# The rectangle is scan-converted to the original pixels whose rotated cell, given by the frame cells of frameGrid,
+# lies inside it.
+# Returns the sum and the blob's positive pixels as rows, cols, rotated cells and scaled scores.
+def scoreFrameRectangle(img,dividers,angle,TLr,TLc,BRr,BRc,minM,maxM,cells):
+
+    # Window of the original raster holding the rotated rectangle.
+    transform,outShape = rotationTransform(img.shape,angle)
+    corners = np.array([[TLc-1,TLc-1,BRc,BRc],[TLr-1,BRr,TLr-1,BRr],[1,1,1,1]])
+    x,y = transform@corners
+    r0,r1 = max(int(np.floor(y.min())),0),min(int(np.ceil(y.max()))+1,img.shape[0])
+    c0,c1 = max(int(np.floor(x.min())),0),min(int(np.ceil(x.max()))+1,img.shape[1])
+    U,V = cells[0][r0:r1,c0:c1],cells[1][r0:r1,c0:c1]
+    inRect = (U>=TLr)&(U<BRr)&(V>=TLc)&(V<BRc)
+
+    # Positive pixels in search area divided into contiguous blobs for individual scoring.
+    blobs,numBlobs = ndimage.label(dividerMask(dividers[r0:r1,c0:c1])&inRect)
+    if numBlobs==0:
+        return 0,None
+    blobAreas = np.bincount(blobs.ravel())
+    bestBlob = np.argmax(blobAreas[1:])+1
+    if blobAreas[bestBlob]<minM or blobAreas[bestBlob]>maxM:
+        return 0,None
+
+    # Same checks as checkSum and rectCheck, with rows and columns taken in the rotated frame.
+    window = img[r0:r1,c0:c1]
+    blob = (blobs==bestBlob)&(window>0)
+    useableArea = np.sum(window[blob]>1)
+    if useableArea<minM or useableArea>maxM:
+        return 0,None
+    if not np.bincount(U[blob]-TLr,minlength=BRr-TLr).all() or not np.bincount(V[blob]-TLc,minlength=BRc-TLc).all():
+        return 0,None
+    factor = rectFactor(blob.sum()/((BRr-TLr)*(BRc-TLc)))
+    scores = window[blob]*factor
+    rows,cols = np.nonzero(blob)
+    return scores.sum(),(rows+r0,cols+c0,U[blob],V[blob],scores)
+
+# Search rotated rectangles on the unrotated parcel, for every angle in angles (degrees).
+# The primary rotation startRot gets the same 1.07 weighting as in parcelSearch.
+# Returns the best result in the iterateCorners format, the AOI matrix being in the rotated frame for write.overlay.
+def frameSearch(img,dividers,minM,maxM,angles,startRot,stride=70):
+    best = [0,0,0,0,0,startRot,0]
+    bestPixels = None
+    for angle in angles:
+        img01 = img
+        if angle == startRot:
+            img01 = scalePositive(img01,1.07)
+        tables,outShape,cells = buildFrameTables(img01,angle)
+        candidates = batchCandidates(0,0,outShape[0],outShape[1],minM,maxM,tables,stride)
+        bounds = rectBound(tables,candidates[:,0],candidates[:,2],candidates[:,1],candidates[:,3])
+        order = np.argsort(-bounds,kind='stable')
+
+        # Highest bounds first, stopping once no bound can beat the best sum of any angle.
+        for bound,(TLr,TLc,BRr,BRc) in zip(bounds[order].tolist(),candidates[order].tolist()):
+            if bound<=best[0]:
+                break
+            tempSum,pixels = scoreFrameRectangle(img01,dividers,angle,TLr,TLc,BRr,BRc,minM,maxM,cells)
+            if tempSum>best[0]:
+                best = [tempSum,TLc,TLr,BRc,BRr,angle,0]
+                bestPixels = pixels
+
+    # Scaled scores are placed in the rectangle's rotated frame cells.
+    if bestPixels is not None:
+        tempSum,TLc,TLr,BRc,BRr,angle,placeMatrix = best
+        rows,cols,U,V,scores = bestPixels
+        placeMatrix = np.zeros((BRr-TLr,BRc-TLc))
+        np.maximum.at(placeMatrix,(U-TLr,V-TLc),scores)
+        best[6] = placeMatrix
+    return best
 
 # Combines all previous helper functions.
-def parcelSearch(img,dividers,minAcres,maxAcres):
+# Rectangles are searched on a grid of stride meters, batch selects the vectorized candidate filter.
+# If pyramid levels are given, e.g. (8,4,1), the coarse-to-fine pyramidSearch is used instead,
+# falling back to the full-resolution search if it finds no usable rectangle.
+# Interpolation selects how rotated rasters are resampled, see rotateImg.
+# If frame is True, rotated rectangles are searched on the unrotated parcel with frameSearch.
+# Angles then default to every 5 degrees from the primary rotation.
+# With workers above 1, the rotations are searched in parallel by parallelSearch, on threads or processes.
+# Valid is the mask of pixels inside the parcel from score.scoreParcel, if given.
+def parcelSearch(img,dividers,minAcres,maxAcres,stride=70,batch=False,pyramid=None,interpolation='bilinear',
+                 frame=False,angles=None,workers=1,processes=False,valid=None):
 
     # Check if parcel is large enough to hold AOI
-    useable,minM,maxM = sizeCheck(minAcres,maxAcres,img)
+    useable,minM,maxM = sizeCheck(minAcres,maxAcres,img,valid)
     results = []
 
     # Check positive score of every blob, in every searching rectangle, of every rotation.
     # Optimal score, coordinates, and rotation returned for .shp file generation.
-    if useable == True:
+    if useable == True and pyramid is not None:
+        result = pyramidSearch(img,dividers,minM,maxM,pyramid,stride,interpolation=interpolation)
+        if result is not None:
+            return result
+    if useable == True and frame:
+        startRot = rotationCheck(img)
+        if angles is None:
+            angles = list(range(startRot,startRot+90,5))
+        return frameSearch(img,dividers,minM,maxM,angles,startRot,stride)
+    elif useable == True:
         startRot = rotationCheck(img)
         rotations = [startRot,startRot+15,startRot+30,startRot+45,startRot+60,startRot+75]
-        for r in rotations:
-            img01 = img
-            if r == startRot:
-                img01 = np.where(img01<=0,img01,1.07*img01)
-            rotated,columnsStart,columnsEnd,rowsStart,rowsEnd,rotatedDiv =(rotateImg(r,img01,dividers))
-            results.append(iterateCorners(rowsStart,columnsStart,rowsEnd,columnsEnd,minM,maxM,rotatedDiv,r,rotated))
+        # The tables and candidates of every rotation are kept for its search.
+        # With workers above 1, rotations are prepared on a thread pool, blob labels included for parallelSearch.
+        if workers > 1:
+            with ThreadPoolExecutor(workers) as executor:
+                prepared = list(executor.map(lambda r:prepareRotation(img,dividers,r,startRot,minM,maxM,stride,
+                                                                      interpolation,not processes),rotations))
+        else:
+            prepared = [prepareRotation(img,dividers,r,startRot,minM,maxM,stride,interpolation) for r in rotations]
+
+        # Rotations are searched from the highest bound down, and dropped once they can't beat the best sum.
+        prepared.sort(key=itemgetter(0),reverse=True)
+        bestSum = 0
+        if workers > 1:
+            results = parallelSearch(prepared,minM,maxM,stride,workers,processes)
+            prepared = []
+        for bound,r,rotated,rotatedDiv,tables,candidates,blobIndex in prepared:
+            if bound <= bestSum:
+                break
+            results.append(iterateCorners(0,0,rotated.shape[0],rotated.shape[1],minM,maxM,rotatedDiv,r,rotated,stride,batch,
+                                          tables=tables,bestSum=bestSum,candidates=candidates))
+            bestSum = max(bestSum,results[-1][0])
+        if len(results)==0:
+            results.append([0,0,0,0,0,startRot,0])
         try:
             # print(max(results,key=itemgetter(0))[:])
             return max(results,key=itemgetter(0))[:]
@@ -0,0 +1,36 @@
+# Tests of the blob selection in search.py.
+import numpy as np
+import search
+
+
+# A searching rectangle holding only dividers has no blob, so both blob functions give an empty mask
+# and the rectangle scores 0 rather than its whole area.
+def test_all_divider_window():
+    img = np.full((60,60),50,dtype=np.float32)
+    dividers = np.ones((60,60),dtype=bool)
+    dividers[10:50,10:50] = False
+    blobIndex = search.buildBlobs(dividers)
+
+    contMatrix = search.createDivider(dividers,10,50,10,50)
+    blobs = search.calculateBlobs(contMatrix,100,1600)
+    assert isinstance(blobs,np.ndarray) and not blobs.any()
+    blobs = search.windowBlobs(blobIndex,10,50,10,50,100,1600)
+    assert isinstance(blobs,np.ndarray) and not blobs.any()
+
+    assert search.scoreRectangle(img,dividers,10,10,50,50,100,1600)[0] == 0
+    assert search.scoreRectangle(img,dividers,10,10,50,50,100,1600,blobIndex)[0] == 0
+
+
+# Blobs are the same whether labelled for each rectangle or taken from the labels of the whole raster.
+def test_window_blobs_match_calculate_blobs():
+    rng = np.random.default_rng(0)
+    dividers = rng.random((80,80))>0.35
+    blobIndex = search.buildBlobs(dividers)
+    for TLr,TLc,BRr,BRc in rng.integers(0,80,(300,4)):
+        TLr,BRr = sorted((TLr,BRr))
+        TLc,BRc = sorted((TLc,BRc))
+        if BRr == TLr or BRc == TLc:
+            continue
+        expected = search.calculateBlobs(search.createDivider(dividers,TLr,BRr,TLc,BRc),1,4000)
+        found = search.windowBlobs(blobIndex,TLr,BRr,TLc,BRc,1,4000)
+        assert np.array_equal(expected,found)
@@ -1,21 +1,28 @@
-# Module to write final AOI mask .shp from search.py.
-from scipy.ndimage import rotate
+# Module to write final AOI polygons from search.py.
 import math
 import numpy as np
 import cv2
 import rasterio
+import fiona
+from rasterio import features
 import os
-import gdal_polygonize as gdp
+from rotation import rotationTransform, unrotate
+from score import landcoverPath
+import countystore
 import matplotlib.pyplot as plt
 
-# Create empty array of size parcel, rotate to the best rotation.
+# Layer and fields of the AOI GeoPackage, as the merged .shp had them.
+aoiLayer = 'aoi'
+aoiSchema = {'geometry':'Polygon','properties':{'DN':'int','parcel':'str:15','sum':'str:15'}}
+
+# Create empty array of the parcel's rotated frame, using the transform cached by the search.
 # Copy the bestBlob(placeCheck) onto rotated image.
-# Reverse rotation to properly align blob.
+# Reverse rotation to properly align blob, directly into the parcel's own frame.
 def overlay(img,TLc,TLr,BRc,BRr,rotation,placeCheck):
-    final = rotate(np.zeros(img.shape),rotation,reshape=True).astype('float64')
+    transform,rotatedShape = rotationTransform(img.shape,rotation)
+    final = np.zeros(rotatedShape,dtype=np.float32)
     final[TLr:BRr,TLc:BRc]=placeCheck
-    final = rotate(final,-rotation,reshape=True)
-    final[final<-2]=1
+    final = unrotate(final,img.shape,rotation)
     final[final<1]=0
     final[final>0]=1
     return final
@@ -46,13 +53,17 @@ def convolve(reshapeFinal):
     convolved[convolved>0]=1
     return convolved
 
-# Masks image by those areas where original parcel is positive (viable).
+# Masks image by those areas where original parcel is valid.
+# Img is the parcel's boolean valid mask, or a raster whose negative values are nodata.
 def mask(img,convolved):
     # print(convolved.shape)
-    mask = (img>=0)
-    zeros = np.zeros((convolved.shape))
-    np.copyto(zeros,convolved,casting='same_kind',where=mask)
-    masked = (zeros[np.newaxis,...]).astype('uint8')
+    if img.dtype == bool:
+        mask = img
+    else:
+        mask = (img>=0)
+    zeros = np.zeros((convolved.shape),dtype=np.uint8)
+    np.copyto(zeros,convolved,casting='unsafe',where=mask)
+    masked = zeros[np.newaxis,...]
     # print(masked)
     # print(masked.shape,masked.sum())
     # fig,ax = plt.subplots(1)
@@ -60,42 +71,39 @@ def mask(img,convolved):
     # plt.show()
     return masked
 
-# Function to create .shp from blob mask.
+# Return the coordinate system as WKT and the transform of a parcel's frame.
+# Georeferenced from the county store's parcel window, or the parcel's landcover, the first page of a stacked parcel.
+def parcelGeoref(srcDir,imgName,county):
+    if countystore.hasParcel(srcDir,imgName):
+        transformation,projection = countystore.parcelTransform(srcDir,imgName)
+        return projection,rasterio.Affine(*transformation)
+    defPath = landcoverPath(county,imgName)
+    # print(defPath)
+    with rasterio.open(defPath) as defSet:
+        return defSet.crs.to_wkt(),defSet.transform
+
+# Function to polygonize the blob mask in memory, as gdal_polygonize did.
 # Also adds tabular info summarizing the total AOI score.
 # Allows for AOI to be compared with those from other parcels.
-def projectWrite(outDir,masked,srcDir,imgName,sum,county):
-    if os.path.isdir(outDir) == False:
-        os.mkdir(outDir)
+# Returns the coordinate system as WKT and the AOI records, to be written by the parent process with appendAois.
+def aoiFeatures(masked,srcDir,imgName,sum,county):
     parcelName = os.path.splitext(imgName)[0]
-    outPath = os.path.join(outDir,imgName)
-    defPath = os.path.join(srcDir,'{}_landcover/{}'.format(county,imgName))
-    # print(defPath)
-    defSet = rasterio.open(defPath)
-    projection = defSet.meta['crs']
-    transformation = defSet.meta['transform']
-    with rasterio.open(outPath, "w",
-                        driver='GTiff',
-                        crs=projection,
-                        height=masked.shape[1],
-                        width=masked .shape[2],
-                        count=1,
-                        dtype=masked.dtype,
-                        nodata=0,
-                        transform=transformation) as dest:
-        dest.write(masked)
-    shpPath = os.path.join(outDir,parcelName+'.shp')
-    gdp.main(outPath,shpPath)
-    os.chdir(outDir)
-    os.system('ogrinfo -q {} -sql "ALTER TABLE {} ADD COLUMN parcel character(15)"'.format(shpPath,parcelName))
-    os.system('ogrinfo -q {} -dialect sqlite -sql "UPDATE \'{}\' SET parcel = {}"'.format(shpPath,parcelName,parcelName))
-    os.system('ogrinfo -q {} -sql "ALTER TABLE {} ADD COLUMN sum character(15)"'.format(shpPath,parcelName))
-    os.system('ogrinfo -q {} -dialect sqlite -sql "UPDATE \'{}\' SET sum = {}"'.format(shpPath,parcelName,sum))
-    os.system('ogr2ogr -q -f "ESRI Shapefile" -update -append merge.shp {}'.format(shpPath))
+    projection,transformation = parcelGeoref(srcDir,imgName,county)
+    records = []
+    for geom,value in features.shapes(masked[0],mask=masked[0]>0,transform=transformation):
+        records.append({'geometry':geom,'properties':{'DN':int(value),'parcel':parcelName[:15],'sum':str(sum)[:15]}})
+    return projection,records
+
+# Open the AOI GeoPackage layer for appending, creating it with a spatial index if new.
+# Only the parent process writes to it, so workers never append concurrently.
+def openAois(path,projection):
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    if os.path.isfile(path):
+        return fiona.open(path,'a',layer=aoiLayer)
+    return fiona.open(path,'w',driver='GPKG',layer=aoiLayer,schema=aoiSchema,crs_wkt=projection,
+                      SPATIAL_INDEX='YES')
 
-    #Cleanup
-    #Deleted masked raster
-    os.remove(outPath)
-    #List of shp dependencies
-    deps = ['.dbf','.prj','.shx','.shp']
-    for d in deps:
-        os.remove(os.path.join(outDir,parcelName+d))
+# Append AOI records from workers to the open layer in one batch and write them out.
+def appendAois(collection,records):
+    collection.writerecords(records)
+    collection.flush()